@@ -0,0 +1,298 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import fastcopy
+import fileops
+import patches
+import utils
+
+from delta import make_patch
+from index import TrigramIndex
+from manifest import Manifest
+from shutil import copyfile
+from utils import REGIONS
+
+
+# lua files in the base dir, lines per file, MB per region archive
+SIZES = {
+    'small': (60, 300, 1),
+    'medium': (250, 600, 4),
+    'large': (800, 1200, 8),
+}
+# share of base dir files each region extract dir contains
+REGION_SHARE = 0.3
+# share of extracted files that are out of date
+STALE_SHARE = 0.1
+
+LINE_TEMPLATES = [
+    'function OnEvent_{n}(proxy, param)',
+    '    proxy:OnKeyTime2( {n}, "OnEvent_{n}_1", {f}, 0, 0, once );',
+    '    proxy:OnActionCheckKey({n}, 10000, "OnEvent_{n}", HELPID_CHECK_OUJOU, {k});',
+    '    proxy:PlayAnimation( {n}, {a} );',
+    '    proxy:SetEventFlag( {n}, true );',
+    '    if proxy:IsCompleteEvent( {n} ) == true then',
+    '    --{jp}',
+    '    print("OnEvent_{n} end");',
+    '    end',
+    'end',
+    '',
+]
+JAPANESE = ['城', '坑道', '牢', '塔', '沼', '嵐', 'イベント', '終了', '開始', '削除']
+
+
+def lua_text(rng, lines):
+    out = []
+    for _ in range(lines):
+        out.append(rng.choice(LINE_TEMPLATES).format(
+            n=rng.randrange(1000, 20000), f=rng.random() * 10,
+            k=rng.randrange(5), a=rng.choice([70, 1510, 7410]),
+            jp=''.join(rng.choice(JAPANESE) for _ in range(4))
+        ))
+    return '\n'.join(out) + '\n'
+
+
+def write_lua(path, text):
+    with open(path, 'w', encoding='shift_jis', newline='') as outfile:
+        outfile.write(text)
+
+
+def generate_tree(dir, files=60, lines=300, blob_mb=1, seed=0):
+    # a script dir as it looks before "Prepare files": loose .lua files,
+    # the region extract dirs and m0N.luabnd.dcx(.sdat) archives, with
+    # some extracted files stale and the .dcx differing from the .sdat
+    rng = random.Random(seed)
+    names = []
+    for i in range(files):
+        name = 'm{:02}_{:02}_{:02}_{:02}.lua'.format(
+            rng.choice(REGIONS), i // 100, i % 100, rng.randrange(4)
+        )
+        text = lua_text(rng, lines)
+        write_lua(os.path.join(dir, name), text)
+        names.append((name, text))
+    for num in REGIONS:
+        extract_dir = utils.extract_dir(dir, num)
+        os.makedirs(extract_dir)
+        for name, text in rng.sample(names, int(len(names) * REGION_SHARE)):
+            if rng.random() < STALE_SHARE:
+                text = lua_text(rng, lines)
+            write_lua(os.path.join(extract_dir, name), text)
+        original = rng.randbytes(blob_mb << 20)
+        rebuilt = bytearray(original)
+        start = rng.randrange(len(rebuilt) // 2)
+        rebuilt[start:] = rng.randbytes(len(rebuilt) - start)
+        dcx_path = os.path.join(dir, f'm0{num}.luabnd.dcx')
+        with open(dcx_path, 'wb') as outfile:
+            outfile.write(rebuilt)
+        with open(dcx_path + '.sdat', 'wb') as outfile:
+            outfile.write(original)
+    return names
+
+
+def touch_dcx(dir):
+    # stand in for rebuilding the archives after an edit
+    for num in REGIONS:
+        with open(os.path.join(dir, f'm0{num}.luabnd.dcx'), 'r+b') as outfile:
+            outfile.seek(-1, os.SEEK_END)
+            last = outfile.read(1)[0]
+            outfile.seek(-1, os.SEEK_END)
+            outfile.write(bytes([last ^ 0xff]))
+
+
+def timed(func, *args, **kwargs):
+    start_time = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start_time, result
+
+
+def dmp_patch(source_path, target_path, patch_path):
+    from diff_match_patch import diff_match_patch
+    dmp = diff_match_patch()
+    with open(target_path, 'rb') as infile:
+        modded_data = infile.read().hex()
+    with open(source_path, 'rb') as infile:
+        unmodded_data = infile.read().hex()
+    diff = dmp.patch_toText(dmp.patch_make(unmodded_data, modded_data))
+    with open(patch_path, 'w+') as outfile:
+        outfile.write(diff)
+    return {'patch': os.path.getsize(patch_path)}
+
+
+def bench_delta(dir, dmp=True):
+    results = {}
+    with tempfile.TemporaryDirectory() as out_dir:
+        for num in REGIONS:
+            target_path = os.path.join(dir, patches.sdat_name(num))
+            source_path = target_path + '.bak'
+            if not os.path.isfile(target_path) \
+                    or not os.path.isfile(source_path):
+                continue
+            patch_path = os.path.join(out_dir, f'm0{num}.patch')
+            duration, stats = timed(
+                make_patch, source_path, target_path, patch_path
+            )
+            result = {'delta': dict(stats, seconds=duration)}
+            if dmp:
+                duration, stats = timed(
+                    dmp_patch, source_path, target_path, patch_path + '.dmp'
+                )
+                result['dmp'] = dict(stats, seconds=duration)
+            results[f'm0{num}'] = result
+    return results
+
+
+def bench_copy(dir, size_mb=16, repeat=3):
+    # dir decides the filesystem under test, reflink needs btrfs/xfs etc.
+    results = {}
+    with tempfile.TemporaryDirectory(dir=dir) as work_dir:
+        src = os.path.join(work_dir, 'src.dcx')
+        dst = os.path.join(work_dir, 'src.dcx.sdat')
+        with open(src, 'wb') as outfile:
+            for _ in range(size_mb):
+                outfile.write(os.urandom(1 << 20))
+        candidates = [(s, [s]) for s in fastcopy.STRATEGIES[:-1]]
+        candidates.append(('auto', fastcopy.STRATEGIES))
+        for name, strategies in candidates:
+            times = []
+            used = None
+            for _ in range(repeat):
+                try:
+                    duration, used = timed(
+                        fastcopy.copy_file, src, dst, strategies
+                    )
+                except OSError:
+                    break
+                times.append(duration)
+            results[name] = {'seconds': min(times), 'used': used} \
+                if times else {'seconds': None, 'used': None}
+        results['shutil.copyfile'] = {
+            'seconds': min(timed(copyfile, src, dst)[0] for _ in range(repeat)),
+            'used': 'copyfile'
+        }
+    return {'size_mb': size_mb, 'results': results}
+
+
+def bench_suite(size, seed=0):
+    files, lines, blob_mb = SIZES[size]
+    results = {}
+
+    def record(name, func, *args):
+        results[name], _ = timed(func, *args)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        dir = os.path.join(work_dir, 'script')
+        patch_dir = os.path.join(work_dir, 'patches')
+        os.makedirs(dir)
+        os.makedirs(patch_dir)
+        # keep the index and manifest out of the real BASE_DIR
+        utils._index = TrigramIndex(os.path.join(work_dir, 'destuff.index'))
+        utils._manifest = Manifest(os.path.join(work_dir, 'destuff.manifest'))
+        record('generate', generate_tree, dir, files, lines, blob_mb, seed)
+        record('find_plain_cold', utils.find, dir, 'OnEvent_1234', True)
+        utils.get_cache().clear()  # warm index, cold result cache
+        record('find_plain', utils.find, dir, 'OnEvent_1234', True)
+        record('find_plain_cached', utils.find, dir, 'OnEvent_1234', True)
+        record('find_case_insensitive', utils.find, dir, 'helpid_check')
+        record('find_regex', utils.find, dir, r'PlayAnimation\( \d+, 7410', False, True)
+        record('find_regex_no_literal', utils.find, dir, r'\d{5}', False, True)
+        record('prepare_files', fileops.prepare_files, dir)
+        record('update_global', utils.update_global, dir)
+        record('update_global_unchanged', utils.update_global, dir)
+        touch_dcx(dir)
+        record('update_sdat', utils.update_sdat, dir)
+        record('update_sdat_unchanged', utils.update_sdat, dir)
+        record('gen_patches', patches.gen_patches, dir, patch_dir)
+        record('reset_temporarily', fileops.reset_temporarily, dir)
+        record('restore_modifications', fileops.restore_modifications, dir)
+        utils.shutdown_engine()
+        utils.save_indexes()
+        utils._index = None
+        utils._manifest = None
+    return {
+        'files': files, 'lines': lines, 'blob_mb': blob_mb, 'seconds': results
+    }
+
+
+def run_suite(sizes, seed=0):
+    return {
+        'python': sys.version.split()[0],
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'sizes': {size: bench_suite(size, seed) for size in sizes}
+    }
+
+
+def compare(old, new):
+    # new / old duration per size and operation, > 1 is slower
+    ratios = {}
+    for size, result in new['sizes'].items():
+        if size not in old['sizes']:
+            continue
+        old_seconds = old['sizes'][size]['seconds']
+        ratios[size] = {
+            name: round(seconds / old_seconds[name], 3)
+            for name, seconds in result['seconds'].items()
+            if old_seconds.get(name)
+        }
+    return ratios
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='DeStuff benchmarks')
+    sub = parser.add_subparsers(dest='bench', required=True)
+    delta_parser = sub.add_parser(
+        'delta', help='binary delta vs diff_match_patch on the region sdats'
+    )
+    delta_parser.add_argument('dir')
+    delta_parser.add_argument('--no-dmp', action='store_true')
+    copy_parser = sub.add_parser(
+        'copy', help='kernel/reflink copy strategies vs shutil.copyfile'
+    )
+    copy_parser.add_argument('dir')
+    copy_parser.add_argument('--size-mb', type=int, default=16)
+    suite_parser = sub.add_parser(
+        'suite', help='hot paths on generated script trees'
+    )
+    suite_parser.add_argument(
+        '--sizes', nargs='+', choices=list(SIZES), default=['small', 'medium']
+    )
+    suite_parser.add_argument('--seed', type=int, default=0)
+    suite_parser.add_argument('-o', '--output', help='also write results here')
+    compare_parser = sub.add_parser(
+        'compare', help='duration ratios between two suite result files'
+    )
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    generate_parser = sub.add_parser(
+        'generate', help='write a synthetic script dir'
+    )
+    generate_parser.add_argument('dir')
+    generate_parser.add_argument('--size', choices=list(SIZES), default='small')
+    generate_parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    if args.bench == 'delta':
+        results = bench_delta(args.dir, dmp=not args.no_dmp)
+    elif args.bench == 'copy':
+        results = bench_copy(args.dir, args.size_mb)
+    elif args.bench == 'suite':
+        results = run_suite(args.sizes, args.seed)
+        if args.output:
+            with open(args.output, 'w') as outfile:
+                json.dump(results, outfile, indent=2)
+    elif args.bench == 'compare':
+        with open(args.old) as old, open(args.new) as new:
+            results = compare(json.load(old), json.load(new))
+    elif args.bench == 'generate':
+        os.makedirs(args.dir, exist_ok=True)
+        files, lines, blob_mb = SIZES[args.size]
+        generate_tree(args.dir, files, lines, blob_mb, args.seed)
+        results = {'dir': args.dir, 'files': files}
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
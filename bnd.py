@@ -0,0 +1,271 @@
+import ntpath
+import os
+import struct
+import zlib
+
+
+# DCX (DFLT): fixed 0x4C byte big endian header, then one zlib stream
+#   0x00 'DCX\0', 0x18 'DCS\0' uncompressed size, compressed size,
+#   0x24 'DCP\0' 'DFLT' compression params, 0x44 'DCA\0' 8
+DCX_MAGIC = b'DCX\0'
+DCX_HEADER = struct.Struct('>4s5I4s2I4s4s6I4sI')
+DCX_SIZES = 0x1C
+READ_CHUNK = 1 << 20
+DFLT_LEVEL = 9
+
+# BND3: 0x20 byte header, fixed size entry headers, shift_jis names
+BND3_MAGIC = b'BND3'
+BND3_HEADER_SIZE = 0x20
+FORMAT_BIG_ENDIAN = 0x01
+FORMAT_IDS = 0x02
+FORMAT_NAMES = 0x04 | 0x08
+FORMAT_LONG_OFFSETS = 0x10
+FORMAT_COMPRESSION = 0x20
+DATA_ALIGN = 0x10
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def read_dcx_header(infile):
+    raw = infile.read(DCX_HEADER.size)
+    if len(raw) != DCX_HEADER.size or raw[:4] != DCX_MAGIC:
+        raise ArchiveError('not a DCX file')
+    fields = DCX_HEADER.unpack(raw)
+    if fields[6] != b'DCS\0' or fields[9] != b'DCP\0':
+        raise ArchiveError('unexpected DCX header layout')
+    if fields[10] != b'DFLT':
+        raise ArchiveError(f'unsupported DCX compression {fields[10]!r}')
+    return raw, fields[7], fields[8]
+
+
+def read_dcx(path):
+    # -> (raw header, decompressed payload), the payload is inflated
+    # while it is read instead of reading the compressed file whole
+    with open(path, 'rb') as infile:
+        header, size, compressed_size = read_dcx_header(infile)
+        decompressor = zlib.decompressobj()
+        data = bytearray()
+        remaining = compressed_size
+        while remaining > 0:
+            chunk = infile.read(min(READ_CHUNK, remaining))
+            if not chunk:
+                raise ArchiveError(f'{path} is truncated')
+            data += decompressor.decompress(chunk)
+            remaining -= len(chunk)
+        data += decompressor.flush()
+    if len(data) != size:
+        raise ArchiveError(f'{path} inflates to {len(data)} bytes, not {size}')
+    return header, bytes(data)
+
+
+def decompress_dcx(data):
+    # DCX held in memory, e.g. a compressed BND entry
+    header = data[:DCX_HEADER.size]
+    if len(header) != DCX_HEADER.size or header[:4] != DCX_MAGIC:
+        raise ArchiveError('not a DCX file')
+    size, compressed_size = struct.unpack_from('>II', header, DCX_SIZES)
+    return zlib.decompress(
+        data[DCX_HEADER.size:DCX_HEADER.size + compressed_size], bufsize=size
+    )
+
+
+def reverse_bits(byte):
+    return int(f'{byte:08b}'[::-1], 2)
+
+
+def binder_format(raw, bit_big_endian):
+    # the format byte is stored bit reversed unless told otherwise
+    if bit_big_endian or (raw & 1 and not raw & 0x80):
+        return raw
+    return reverse_bits(raw)
+
+
+def entry_header_size(fmt):
+    size = 12 if not fmt & FORMAT_LONG_OFFSETS else 16
+    for flag in (FORMAT_IDS, FORMAT_NAMES, FORMAT_COMPRESSION):
+        if fmt & flag:
+            size += 4
+    return size
+
+
+class Bnd3:
+    # entries: [{'id', 'name', 'flags', 'offset', 'size'}] in archive
+    # order, data is the whole archive so entries are slices of it
+    def __init__(self, data, dcx_header=None):
+        if data[:4] != BND3_MAGIC:
+            raise ArchiveError('not a BND3 archive')
+        self.data = data
+        self.dcx_header = dcx_header
+        self.header = data[:BND3_HEADER_SIZE]
+        self.version = data[4:12].rstrip(b'\0').decode('ascii', 'replace')
+        self.raw_format = data[0xC]
+        self.bit_big_endian = data[0xE] != 0
+        self.format = binder_format(self.raw_format, self.bit_big_endian)
+        self.big_endian = data[0xD] != 0 or bool(self.format & FORMAT_BIG_ENDIAN)
+        self.endian = '>' if self.big_endian else '<'
+        count = self.unpack('i', 0x10)
+        self.entries = [
+            self.read_entry_header(
+                BND3_HEADER_SIZE + i * entry_header_size(self.format)
+            )
+            for i in range(count)
+        ]
+        self.by_name = {}
+        for entry in self.entries:
+            if entry['name'] is not None:
+                self.by_name.setdefault(short_name(entry['name']), entry)
+
+    def unpack(self, fmt, pos):
+        return struct.unpack_from(self.endian + fmt, self.data, pos)[0]
+
+    def read_entry_header(self, pos):
+        entry = {'flags': self.data[pos], 'id': None, 'name': None}
+        entry['size'] = self.unpack('I', pos + 4)
+        pos += 8
+        if self.format & FORMAT_LONG_OFFSETS:
+            entry['offset'] = self.unpack('Q', pos)
+            pos += 8
+        else:
+            entry['offset'] = self.unpack('I', pos)
+            pos += 4
+        if self.format & FORMAT_IDS:
+            entry['id'] = self.unpack('i', pos)
+            pos += 4
+        if self.format & FORMAT_NAMES:
+            name_offset = self.unpack('I', pos)
+            end = self.data.index(b'\0', name_offset)
+            entry['name'] = self.data[name_offset:end].decode('shift_jis')
+            pos += 4
+        if self.format & FORMAT_COMPRESSION:
+            entry['uncompressed'] = self.unpack('I', pos)
+        if entry['offset'] + entry['size'] > len(self.data):
+            raise ArchiveError(f'entry {entry["name"]} runs past the archive')
+        return entry
+
+    def raw(self, entry):
+        return self.data[entry['offset']:entry['offset'] + entry['size']]
+
+    def read(self, entry):
+        data = self.raw(entry)
+        if data[:4] == DCX_MAGIC:
+            return decompress_dcx(data)  # entry compressed on its own
+        return data
+
+    def get(self, name):
+        # entry by full or short (file) name, None if missing
+        entry = self.by_name.get(short_name(name))
+        return None if entry is None else self.read(entry)
+
+    def files(self, ext='.lua'):
+        # [(short name, entry)] of the entries with that extension
+        return [
+            (short_name(entry['name']), entry) for entry in self.entries
+            if entry['name'] is not None and entry['name'].endswith(ext)
+        ]
+
+
+def align(n):
+    return -(-n // DATA_ALIGN) * DATA_ALIGN
+
+
+def pack_bnd3(template, replace):
+    # new archive with template's header fields, entry order, ids, names
+    # and flags; replace: {entry index: file contents} for changed entries
+    endian = template.endian
+    entries = template.entries
+    header_size = entry_header_size(template.format)
+    names = bytearray()
+    name_offsets = []
+    names_start = BND3_HEADER_SIZE + header_size * len(entries)
+    for entry in entries:
+        name_offsets.append(names_start + len(names))
+        if entry['name'] is not None:
+            names += entry['name'].encode('shift_jis') + b'\0'
+    headers_end = names_start + len(names)
+    blobs = []
+    sizes = []
+    for i, entry in enumerate(entries):
+        if i not in replace:
+            blobs.append(template.raw(entry))
+            sizes.append(entry.get('uncompressed', entry['size']))
+        elif template.raw(entry)[:4] == DCX_MAGIC:
+            blobs.append(compress_dcx(template.raw(entry), replace[i]))
+            sizes.append(len(replace[i]))
+        else:
+            blobs.append(replace[i])
+            sizes.append(len(replace[i]))
+    offsets = []
+    end = headers_end
+    for blob in blobs:
+        offsets.append(align(end) if blob else end)
+        end = offsets[-1] + len(blob)
+    out = bytearray(end)
+    out[:BND3_HEADER_SIZE] = template.header
+    struct.pack_into(endian + 'iI', out, 0x10, len(entries), headers_end)
+    pos = BND3_HEADER_SIZE
+    offset_format = 'Q' if template.format & FORMAT_LONG_OFFSETS else 'I'
+    for entry, blob, offset, size, name_offset in zip(
+            entries, blobs, offsets, sizes, name_offsets):
+        fields = [len(blob), offset]
+        field_format = 'I' + offset_format
+        if template.format & FORMAT_IDS:
+            fields.append(entry['id'])
+            field_format += 'i'
+        if template.format & FORMAT_NAMES:
+            fields.append(name_offset)
+            field_format += 'I'
+        if template.format & FORMAT_COMPRESSION:
+            fields.append(size)
+            field_format += 'I'
+        out[pos] = entry['flags']
+        struct.pack_into(endian + field_format, out, pos + 4, *fields)
+        pos += header_size
+    out[names_start:headers_end] = names
+    for blob, offset in zip(blobs, offsets):
+        out[offset:offset + len(blob)] = blob
+    return bytes(out)
+
+
+def dcx_header(template, size, compressed_size):
+    header = bytearray(template[:DCX_HEADER.size])
+    struct.pack_into('>II', header, DCX_SIZES, size, compressed_size)
+    return bytes(header)
+
+
+def compress_dcx(template, data):
+    compressed = zlib.compress(data, DFLT_LEVEL)
+    return dcx_header(template, len(data), len(compressed)) + compressed
+
+
+def write_dcx(path, template, data):
+    # template: header of the DCX being replaced, the sizes are patched
+    # in once the payload has been deflated into the file
+    compressor = zlib.compressobj(DFLT_LEVEL)
+    view = memoryview(data)
+    with open(path, 'wb') as outfile:
+        outfile.write(dcx_header(template, len(data), 0))
+        for i in range(0, len(data), READ_CHUNK):
+            outfile.write(compressor.compress(view[i:i + READ_CHUNK]))
+        outfile.write(compressor.flush())
+        compressed_size = outfile.tell() - DCX_HEADER.size
+        outfile.seek(0)
+        outfile.write(dcx_header(template, len(data), compressed_size))
+    return os.path.getsize(path)
+
+
+def short_name(name):
+    # N:\DemonsSoul\data\DVDROOT\script\m01_00_00_00.lua -> m01_00_00_00.lua
+    return ntpath.basename(name)
+
+
+def open_archive(path):
+    # BND3, bare or wrapped in a DCX
+    with open(path, 'rb') as infile:
+        magic = infile.read(4)
+    if magic == DCX_MAGIC:
+        header, data = read_dcx(path)
+        return Bnd3(data, header)
+    with open(path, 'rb') as infile:
+        return Bnd3(infile.read())
@@ -0,0 +1,223 @@
+import hashlib
+import json
+import os
+import struct
+import zlib
+
+from delta import PatchError, copy_range, diff, hash_file, open_map
+from jobs import no_progress
+from patches import sdat_name
+from profiler import profiled
+from utils import BASE_DIR, REGIONS, get_manifest
+
+
+# mod pack:
+#   MAGIC, then zlib compressed literal chunks, each stored once
+#   manifest (zlib compressed JSON) with the chunk table and per file
+#   source/target size and sha256 plus ops, a flat list of
+#   (COPY, source offset, length) / (ADD, chunk index, 0) triples
+#   trailer: manifest offset, manifest length, MAGIC
+MAGIC = b'DSPACK\x01\x00'
+TRAILER = struct.Struct('>QQ8s')
+BUNDLE_NAME = 'destuff-mod.pack'
+BUNDLE_VERSION = 1
+COPY = 0
+ADD = 1
+CHUNK = 1 << 16
+LEVEL = 9
+
+
+class ChunkStore:
+    # content addressed: a literal chunk seen before is referenced again
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.chunks = []
+        self.index = {}
+        self.deduplicated = 0
+
+    def add(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        i = self.index.get(digest)
+        if i is not None:
+            self.deduplicated += 1
+            return i
+        compressed = zlib.compress(data, LEVEL)
+        self.chunks.append(
+            [self.outfile.tell(), len(compressed), len(data), digest]
+        )
+        self.outfile.write(compressed)
+        i = self.index[digest] = len(self.chunks) - 1
+        return i
+
+
+class BundleWriter:
+    # delta.diff writer that puts literals in the chunk store
+    def __init__(self, store):
+        self.store = store
+        self.ops = []
+
+    def copy(self, offset, length):
+        self.ops += [COPY, offset, length]
+
+    def add(self, data, start, end):
+        for i in range(start, end, CHUNK):
+            chunk = bytes(data[i:min(i + CHUNK, end)])
+            self.ops += [ADD, self.store.add(chunk), 0]
+
+
+def bundle_counters(stats):
+    return {
+        'files': stats['files'], 'bytes': stats['literal'],
+        'written': stats['size'], 'cache_hits': stats['deduplicated'],
+    }
+
+
+@profiled(counters=bundle_counters)
+def build_bundle(dir, bundle_path=None, progress=no_progress):
+    # one pack with every region whose .sdat differs from its .sdat.bak
+    if bundle_path is None:
+        bundle_path = os.path.join(BASE_DIR, BUNDLE_NAME)
+    manifest = get_manifest()
+    temp_path = bundle_path + '.tmp'
+    files = []
+    try:
+        with open(temp_path, 'wb') as outfile:
+            outfile.write(MAGIC)
+            store = ChunkStore(outfile)
+            for num in REGIONS:
+                progress(sdat_name(num), len(REGIONS))
+                sdat_path = os.path.join(dir, sdat_name(num))
+                bak_path = sdat_path + '.bak'
+                if not os.path.isfile(sdat_path) \
+                        or not os.path.isfile(bak_path) \
+                        or manifest.digest(sdat_path) == manifest.digest(bak_path):
+                    continue
+                writer = BundleWriter(store)
+                with open_map(bak_path) as source, open_map(sdat_path) as target:
+                    diff(source, target, writer)
+                    files.append({
+                        'name': sdat_name(num),
+                        'source': [len(source), hashlib.sha256(source).hexdigest()],
+                        'target': [len(target), hashlib.sha256(target).hexdigest()],
+                        'ops': writer.ops,
+                    })
+            data = zlib.compress(json.dumps({
+                'version': BUNDLE_VERSION, 'chunks': store.chunks,
+                'files': files
+            }, separators=(',', ':')).encode('utf-8'), LEVEL)
+            offset = outfile.tell()
+            outfile.write(data)
+            outfile.write(TRAILER.pack(offset, len(data), MAGIC))
+        os.replace(temp_path, bundle_path)
+    finally:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+    manifest.save()
+    return {
+        'files': len(files), 'chunks': len(store.chunks),
+        'deduplicated': store.deduplicated,
+        'literal': sum(chunk[2] for chunk in store.chunks),
+        'size': os.path.getsize(bundle_path),
+    }
+
+
+def read_bundle_manifest(infile):
+    infile.seek(0, os.SEEK_END)
+    size = infile.tell()
+    infile.seek(0)
+    if size < len(MAGIC) + TRAILER.size or infile.read(len(MAGIC)) != MAGIC:
+        raise PatchError('not a DeStuff mod pack')
+    infile.seek(size - TRAILER.size)
+    offset, length, magic = TRAILER.unpack(infile.read(TRAILER.size))
+    if magic != MAGIC or offset + length > size - TRAILER.size:
+        raise PatchError('mod pack is truncated')
+    infile.seek(offset)
+    try:
+        manifest = json.loads(zlib.decompress(infile.read(length)))
+    except (zlib.error, ValueError):
+        raise PatchError('mod pack manifest is corrupt')
+    if not isinstance(manifest, dict) \
+            or manifest.get('version') != BUNDLE_VERSION:
+        raise PatchError('unsupported mod pack version')
+    # chunks must lie between MAGIC and the manifest
+    for chunk in manifest.get('chunks', []):
+        chunk_offset, size = chunk[:2]
+        if chunk_offset < len(MAGIC) or size < 0 \
+                or chunk_offset + size > offset:
+            raise PatchError('mod pack chunk table is corrupt')
+    return manifest
+
+
+def apply_file(pack, chunks, entry, source_path, target_path):
+    # streams source copies and pack chunks into a temp file, target_path
+    # is only replaced once the result hash matches the manifest
+    source_size, source_sha = entry['source']
+    target_size, target_sha = entry['target']
+    if os.path.getsize(source_path) != source_size \
+            or hash_file(source_path).hex() != source_sha:
+        raise PatchError(f'{source_path} does not match the mod pack source')
+    ops = entry['ops']
+    if len(ops) % 3:
+        raise PatchError('mod pack ops are truncated')
+    temp_path = target_path + '.tmp'
+    sha = hashlib.sha256()
+    try:
+        with open(source_path, 'rb') as source, \
+                open(temp_path, 'wb') as outfile:
+            for kind, a, b in zip(ops[0::3], ops[1::3], ops[2::3]):
+                if kind == COPY:
+                    if a < 0 or b < 0 or a + b > source_size:
+                        raise PatchError('copy outside of source')
+                    source.seek(a)
+                    copy_range(source, outfile, sha, b)
+                elif kind == ADD:
+                    if not 0 <= a < len(chunks):
+                        raise PatchError('chunk index outside of mod pack')
+                    offset, size, raw_size, _ = chunks[a]
+                    pack.seek(offset)
+                    try:
+                        data = zlib.decompress(pack.read(size))
+                    except zlib.error:
+                        raise PatchError('corrupt chunk in mod pack')
+                    if len(data) != raw_size:
+                        raise PatchError('corrupt chunk in mod pack')
+                    outfile.write(data)
+                    sha.update(data)
+                else:
+                    raise PatchError(f'unknown mod pack op {kind}')
+            if outfile.tell() != target_size:
+                raise PatchError('mod pack does not match target size')
+        if sha.hexdigest() != target_sha:
+            raise PatchError(f'{target_path} hash mismatch after patching')
+        os.replace(temp_path, target_path)
+    finally:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+    return {'source': source_size, 'target': target_size}
+
+
+def apply_bundle(dir, bundle_path=None, progress=no_progress):
+    if bundle_path is None:
+        bundle_path = os.path.join(BASE_DIR, BUNDLE_NAME)
+    # only the region .sdat names are written, anything else in the
+    # manifest (paths, ..) rejects the whole pack before a file is touched
+    names = {sdat_name(num) for num in REGIONS}
+    results = {}
+    with open(bundle_path, 'rb') as pack:
+        manifest = read_bundle_manifest(pack)
+        for entry in manifest['files']:
+            if entry.get('name') not in names:
+                raise PatchError(
+                    f'mod pack has unexpected file {entry.get("name")!r}'
+                )
+        for entry in manifest['files']:
+            progress(entry['name'], len(manifest['files']))
+            target_path = os.path.join(dir, entry['name'])
+            try:
+                results[entry['name']] = apply_file(
+                    pack, manifest['chunks'], entry,
+                    target_path + '.bak', target_path
+                )
+            except (OSError, PatchError) as e:
+                results[entry['name']] = {'error': str(e)}
+    return results
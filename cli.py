@@ -0,0 +1,217 @@
+import argparse
+import json
+import os
+import sys
+
+import utils
+
+
+# tkinter is never imported here, everything past utils is imported
+# by the command that needs it so `cli.py find` starts fast
+
+
+def script_directory():
+    path = os.path.join(utils.BASE_DIR, 'destuff.json')
+    try:
+        with open(path, 'r') as settings_file:
+            return json.load(settings_file).get('script-directory', '')
+    except (OSError, ValueError):
+        return ''
+
+
+def cmd_find(args):
+    found = utils.find(
+        args.dir, args.term, args.case_sensitive, args.regex, args.workers,
+        args.packed
+    )
+    return [
+        {
+            'file': filename,
+            'matches': [
+                {'line': i, 'text': line.rstrip('\r\n')}
+                for i, line in reversed(matches)
+            ]
+        }
+        for filename, matches in found
+    ]
+
+
+def cmd_xref(args):
+    xref = utils.get_xref(args.dir)
+    fields = ['file', 'line', 'kind', 'context']
+    result = {
+        'definitions': xref.definitions(args.dir, args.symbol),
+        'references': xref.references(args.dir, args.symbol),
+    }
+    if args.symbol.isdigit():
+        result['numbers'] = xref.number(args.dir, int(args.symbol))
+    return {
+        key: [dict(zip(fields, record)) for record in records]
+        for key, records in result.items()
+    }
+
+
+def cmd_update_global(args):
+    return utils.update_global(args.dir)
+
+
+def cmd_update_sdat(args):
+    return utils.update_sdat(args.dir)
+
+
+def cmd_prepare(args):
+    from fileops import prepare_files
+    return prepare_files(args.dir)
+
+
+def cmd_reset_temporarily(args):
+    from fileops import reset_temporarily
+    return reset_temporarily(args.dir)
+
+
+def cmd_restore_modifications(args):
+    from fileops import restore_modifications
+    return restore_modifications(args.dir)
+
+
+def cmd_reset_permanently(args):
+    from fileops import reset_permanently
+    reset_permanently(args.dir)
+
+
+def cmd_gen_patches(args):
+    import patches
+    return patches.gen_patches(args.dir, args.patch_dir)
+
+
+def cmd_apply_patches(args):
+    import patches
+    return patches.apply_patches(args.dir, args.patch_dir)
+
+
+def cmd_pack(args):
+    import bundle
+    return bundle.build_bundle(args.dir, args.pack)
+
+
+def cmd_install(args):
+    import bundle
+    return bundle.apply_bundle(args.dir, args.pack)
+
+
+def cmd_repack(args):
+    import repack
+    return repack.repack(args.dir)
+
+
+def cmd_build(args):
+    import repack
+    return repack.build(args.dir)
+
+
+def cmd_watch(args):
+    import watch
+    watch.main([args.dir])
+
+
+COMMANDS = {
+    'find': (cmd_find, 'search the script dir .lua files'),
+    'xref': (cmd_xref, 'where a function/constant is defined and used, or an event id appears'),
+    'update-global': (cmd_update_global, 'copy edited .lua files into the extract dirs'),
+    'update-sdat': (cmd_update_sdat, 'copy rebuilt .dcx files over the .sdat files'),
+    'repack': (cmd_repack, 'rebuild the .luabnd.dcx archives from their extract dirs'),
+    'build': (cmd_build, 'update-global, repack and update-sdat in one go'),
+    'prepare': (cmd_prepare, 'back up .sdat/.luabnd files and create .sdat copies'),
+    'reset-temporarily': (cmd_reset_temporarily, 'swap the original files back in'),
+    'restore-modifications': (cmd_restore_modifications, 'swap the modified files back in'),
+    'reset-permanently': (cmd_reset_permanently, 'restore the backups, dropping modifications'),
+    'gen-patches': (cmd_gen_patches, 'write region patches from .sdat/.bak pairs'),
+    'apply-patches': (cmd_apply_patches, 'apply region patches to the .bak files'),
+    'pack': (cmd_pack, 'bundle the modified regions into one compressed mod pack'),
+    'install': (cmd_install, 'apply a mod pack to the .bak files'),
+    'watch': (cmd_watch, 'sync base dir edits into the extract dirs as they are saved'),
+}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='destuff')
+    parser.add_argument(
+        '-d', '--dir', default=None,
+        help='script directory, defaults to the one set in destuff.json'
+    )
+    parser.add_argument(
+        '--profile', metavar='PATH', default=None,
+        help='write timings and counters of the command as JSON'
+    )
+    parser.add_argument(
+        '--trace', metavar='PATH', default=None,
+        help='write timings as Chrome trace events (chrome://tracing)'
+    )
+    sub = parser.add_subparsers(dest='command', required=True)
+    for name, (func, help_text) in COMMANDS.items():
+        command_parser = sub.add_parser(name, help=help_text)
+        command_parser.set_defaults(func=func)
+        if name == 'find':
+            command_parser.add_argument('term')
+            command_parser.add_argument(
+                '-c', '--case-sensitive', action='store_true'
+            )
+            command_parser.add_argument('-r', '--regex', action='store_true')
+            command_parser.add_argument('-w', '--workers', type=int, default=None)
+            command_parser.add_argument(
+                '-p', '--packed', action='store_true',
+                help='search the .lua files inside the *.luabnd.dcx archives'
+            )
+        elif name == 'xref':
+            command_parser.add_argument(
+                'symbol', help='OnEvent_4020, proxy:PlayAnimation, HELPID_*, 10000'
+            )
+        elif name in ['gen-patches', 'apply-patches']:
+            command_parser.add_argument('--patch-dir', default=utils.BASE_DIR)
+        elif name in ['pack', 'install']:
+            command_parser.add_argument(
+                '--pack', default=None,
+                help='mod pack path, defaults to destuff-mod.pack next to DeStuff'
+            )
+    args = parser.parse_args(argv)
+    if args.dir is None:
+        args.dir = script_directory()
+    if not os.path.isdir(args.dir):
+        parser.error(f'script directory not found: {args.dir!r}')
+    return args
+
+
+def export_profile(args):
+    from profiler import profiler
+    if args.profile:
+        profiler.export(args.profile)
+    if args.trace:
+        profiler.export(args.trace, trace=True)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        result = args.func(args)
+    except Exception as e:
+        json.dump({'error': str(e)}, sys.stdout)
+        print()
+        return 1
+    finally:
+        utils.save_indexes()
+        export_profile(args)
+    json.dump({'ok': True} if result is None else result, sys.stdout)
+    print()
+    return 1 if failed(result) else 0
+
+
+def failed(result):
+    # per-file results such as apply-patches' {region: {'error': ...}}
+    return isinstance(result, dict) and any(
+        isinstance(value, dict) and 'error' in value
+        for value in result.values()
+    )
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,221 @@
+import hashlib
+import mmap
+import os
+import struct
+
+from contextlib import contextmanager
+
+
+# patch file:
+#   header  magic, source size, target size, source sha256, target sha256
+#   ops     varint (length << 1 | op), copies followed by a zigzag varint
+#           source offset relative to the end of the previous copy,
+#           adds followed by length literal bytes
+MAGIC = b'DSDELTA\x01'
+HEADER = struct.Struct('>8sQQ32s32s')
+COPY = 0
+ADD = 1
+BLOCK = 16
+LITERAL_CHUNK = 1 << 20
+
+
+class PatchError(Exception):
+    pass
+
+
+@contextmanager
+def open_map(path):
+    with open(path, 'rb') as infile:
+        try:
+            data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            yield b''  # empty files can't be mapped
+            return
+        try:
+            yield data
+        finally:
+            data.close()
+
+
+def encode_varint(n):
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def zigzag(n):
+    return n << 1 if n >= 0 else (-n << 1) - 1
+
+
+def index_blocks(source):
+    blocks = {}
+    for offset in range(len(source) - BLOCK, -1, -BLOCK):
+        blocks[source[offset:offset + BLOCK]] = offset
+    return blocks
+
+
+def common_length(a, ai, b, bi):
+    limit = min(len(a) - ai, len(b) - bi)
+    n = 0
+    step = 4096
+    while n < limit:
+        size = min(step, limit - n)
+        if a[ai + n:ai + n + size] == b[bi + n:bi + n + size]:
+            n += size
+            step = min(step * 2, 1 << 20)
+        elif size > BLOCK:
+            step = size // 4
+        else:
+            while n < limit and a[ai + n] == b[bi + n]:
+                n += 1
+            break
+    return n
+
+
+class PatchWriter:
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.copy_end = 0
+        self.copied = 0
+        self.added = 0
+
+    def copy(self, offset, length):
+        self.outfile.write(encode_varint(length << 1 | COPY))
+        self.outfile.write(encode_varint(zigzag(offset - self.copy_end)))
+        self.copy_end = offset + length
+        self.copied += length
+
+    def add(self, data, start, end):
+        for i in range(start, end, LITERAL_CHUNK):
+            chunk = data[i:min(i + LITERAL_CHUNK, end)]
+            self.outfile.write(encode_varint(len(chunk) << 1 | ADD))
+            self.outfile.write(chunk)
+            self.added += len(chunk)
+
+
+def diff(source, target, writer):
+    # greedy block matching: source is indexed at BLOCK aligned offsets,
+    # every target offset is looked up and hits are extended both ways
+    blocks = index_blocks(source)
+    literal_start = 0
+    p = 0
+    end = len(target) - BLOCK
+    while p <= end:
+        offset = blocks.get(target[p:p + BLOCK])
+        if offset is None:
+            p += 1
+            continue
+        back = 0
+        while p - back > literal_start and offset - back > 0 \
+                and target[p - back - 1] == source[offset - back - 1]:
+            back += 1
+        length = BLOCK + back + common_length(
+            source, offset + BLOCK, target, p + BLOCK
+        )
+        p -= back
+        offset -= back
+        writer.add(target, literal_start, p)
+        writer.copy(offset, length)
+        p += length
+        literal_start = p
+    writer.add(target, literal_start, len(target))
+
+
+def make_patch(source_path, target_path, patch_path):
+    with open_map(source_path) as source, open_map(target_path) as target, \
+            open(patch_path, 'wb') as outfile:
+        outfile.write(HEADER.pack(
+            MAGIC, len(source), len(target),
+            hashlib.sha256(source).digest(), hashlib.sha256(target).digest()
+        ))
+        writer = PatchWriter(outfile)
+        diff(source, target, writer)
+        return {
+            'source': len(source),
+            'target': len(target),
+            'copied': writer.copied,
+            'added': writer.added,
+            'patch': outfile.tell()
+        }
+
+
+def read_varint(infile):
+    n = 0
+    shift = 0
+    while True:
+        byte = infile.read(1)
+        if not byte:
+            raise PatchError('truncated patch')
+        n |= (byte[0] & 0x7f) << shift
+        shift += 7
+        if byte[0] < 0x80:
+            return n
+
+
+def unzigzag(n):
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+
+def read_header(infile):
+    header = infile.read(HEADER.size)
+    if len(header) != HEADER.size or header[:len(MAGIC)] != MAGIC:
+        raise PatchError('not a DeStuff patch')
+    return HEADER.unpack(header)[1:]
+
+
+def hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(LITERAL_CHUNK), b''):
+            sha.update(chunk)
+    return sha.digest()
+
+
+def copy_range(infile, outfile, sha, length):
+    while length > 0:
+        chunk = infile.read(min(length, LITERAL_CHUNK))
+        if not chunk:
+            raise PatchError('patch reads past end of input')
+        outfile.write(chunk)
+        sha.update(chunk)
+        length -= len(chunk)
+
+
+def apply_patch(source_path, patch_path, target_path):
+    # streams the patched file next to target_path and only replaces
+    # target_path once the result hash matches the one in the patch
+    with open(patch_path, 'rb') as patch:
+        source_size, target_size, source_sha, target_sha = read_header(patch)
+        if os.path.getsize(source_path) != source_size \
+                or hash_file(source_path) != source_sha:
+            raise PatchError(f'{source_path} does not match the patch source')
+        temp_path = target_path + '.tmp'
+        sha = hashlib.sha256()
+        try:
+            with open(source_path, 'rb') as source, \
+                    open(temp_path, 'wb') as outfile:
+                copy_end = 0
+                while outfile.tell() < target_size:
+                    op = read_varint(patch)
+                    length = op >> 1
+                    if op & 1 == ADD:
+                        copy_range(patch, outfile, sha, length)
+                    else:
+                        offset = copy_end + unzigzag(read_varint(patch))
+                        if offset < 0 or offset + length > source_size:
+                            raise PatchError('copy outside of source')
+                        source.seek(offset)
+                        copy_range(source, outfile, sha, length)
+                        copy_end = offset + length
+                if outfile.tell() != target_size or patch.read(1):
+                    raise PatchError('patch does not match target size')
+            if sha.digest() != target_sha:
+                raise PatchError(f'{target_path} hash mismatch after patching')
+            os.replace(temp_path, target_path)
+        finally:
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+    return {'source': source_size, 'target': target_size}
@@ -1,7 +1,15 @@
+import multiprocessing
+import queue
 import tkinter.filedialog
 
 from utils import *
 from widgets import *
+from jobs import JobBusy, JobScheduler
+from search import SearchResults, SearchThread, term_errors
+
+
+SEARCH_POLL_MS = 50
+JOB_POLL_MS = 100
 
 
 # -------------------------------------------------------------
@@ -28,7 +36,7 @@ class MainWindow(tk.Frame):
 
         self.pack(fill=tk.BOTH, expand=True)
 
-        config_grids(self, rows=[0, 0, 1])
+        config_grids(self, rows=[0, 0, 1, 0])
 
         self.restart_flag = False
 
@@ -37,6 +45,8 @@ class MainWindow(tk.Frame):
 
         self.cont = True
 
+        self.jobs = JobScheduler()
+
         self.menu_bar = Menubar(self)
         self.master.config(menu=self.menu_bar)
 
@@ -48,7 +58,13 @@ class MainWindow(tk.Frame):
 
         self.btn_update_global = tk.Button(
             self.btn_frame, text='Update global files',
-            command=lambda: update_global(self.master.settings['script-directory']), font=self.font_, **self.button_
+            command=lambda: self.run_job(
+                'Update global files', update_global,
+                self.master.settings['script-directory'],
+                on_finish=lambda results: self.set_status(format_results(
+                    'Update global files', results
+                ))
+            ), font=self.font_, **self.button_
         )
         self.btn_update_global.grid(row=0, column=0, **self.button_grid_)
 
@@ -60,7 +76,12 @@ class MainWindow(tk.Frame):
 
         self.btn_update_sdat = tk.Button(
             self.btn_frame, text='Update sdat files',
-            command=lambda: update_sdat(self.directory_), font=self.font_, **self.button_
+            command=lambda: self.run_job(
+                'Update sdat files', update_sdat, self.directory_,
+                on_finish=lambda results: self.set_status(format_results(
+                    'Update sdat files', results
+                ))
+            ), font=self.font_, **self.button_
         )
         self.btn_update_sdat.grid(row=2, column=0, **self.button_grid_)
 
@@ -118,13 +139,34 @@ class MainWindow(tk.Frame):
 
         self.checkbox_regex.grid(row=0, column=2, sticky='nsew')
 
+        self.var_packed = tk.IntVar()
+
+        self.checkbox_packed = tk.Checkbutton(
+            self.checkbox_frame, text='packed archives',
+            variable=self.var_packed, bg=self.light_, fg=self.dark_, font=self.font_,
+            command=self.checkbox_click
+        )
+
+        self.checkbox_packed.grid(row=0, column=3, sticky='nsew')
+
+        self.btn_search_all = tk.Button(
+            self.checkbox_frame, text='Search all saved terms',
+            command=self.search_all, font=self.font_, **btn
+        )
+        self.btn_search_all.grid(row=0, column=4, sticky='nsew')
+
     # ---------------------------------------------------------------
     # -------------------- S E A R C H L I S T S --------------------
     # ---------------------------------------------------------------
 
         list_style = {'font': self.font_, 'relief': 'groove'}
 
-        self.found = []
+        self.found = SearchResults(self.directory_)
+        self.search_thread = None
+        # search all saved terms: term -> matched lines, the results
+        # themselves land in the search cache
+        self.term_counts = {}
+        self.term_results_done = False
 
         self.lists_frame = tk.Frame(self, bg=self.light_)
         self.lists_frame.grid(row=2, column=0, sticky='nsew')
@@ -147,8 +189,10 @@ class MainWindow(tk.Frame):
             )
         )
 
-        for search_term in settings['search-terms']:
-            self.lb_previous_searches.listbox.insert(0, search_term)
+        self.lb_previous_searches.listbox.set_items(
+            reversed(settings['search-terms'])
+        )
+        self.lb_previous_searches.listbox.formatter = self.format_term
 
         self.lb_previous_searches.context_functions = [
             {
@@ -193,6 +237,66 @@ class MainWindow(tk.Frame):
             row=1, column=0, columnspan=2, sticky='nsew'
         )
 
+        self.status_frame = tk.Frame(self, bg=self.light_)
+        self.status_frame.grid(row=3, column=0, sticky='nsew', padx=10)
+        config_grids(self.status_frame, columns=[1, 0])
+
+        self.status = tk.Label(
+            self.status_frame, text='', anchor='w', justify='left',
+            bg=self.light_, fg=self.dark_, font=self.font_
+        )
+        self.status.grid(row=0, column=0, sticky='nsew')
+
+        self.btn_cancel_jobs = tk.Button(
+            self.status_frame, text='Cancel', command=self.jobs.cancel_all,
+            font=self.font_, **btn
+        )
+        self.btn_cancel_jobs.grid(row=0, column=1, sticky='nsew')
+        self.btn_cancel_jobs.grid_remove()
+
+    def set_status(self, text):
+        self.status.config(text=text)
+
+    # -------------------------------------------------
+    # -------------------- J O B S --------------------
+    # -------------------------------------------------
+
+    def run_job(self, label, func, dir, *args, on_finish=None):
+        try:
+            job = self.jobs.submit(label, func, dir, *args)
+        except JobBusy as e:
+            self.set_status(str(e))
+            return
+        self.set_status(f'{label}...')
+        self.btn_cancel_jobs.grid()
+        self.after(JOB_POLL_MS, self.drain_job, job, on_finish)
+
+    def drain_job(self, job, on_finish):
+        progress = None
+        while True:
+            try:
+                kind, value = job.events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'progress':
+                progress = value
+                continue
+            if not self.jobs.jobs():
+                self.btn_cancel_jobs.grid_remove()
+            if job.status == 'failed':
+                self.set_status(f'{job.label} failed: {job.error}')
+            elif job.status == 'cancelled':
+                self.set_status(f'{job.label} cancelled')
+            elif on_finish is not None:
+                on_finish(job.result)
+            else:
+                self.set_status(f'{job.label} done')
+            return
+        if progress is not None:
+            done, total, name = progress
+            self.set_status(f'{job.label}: {done}/{total} {name}')
+        self.after(JOB_POLL_MS, self.drain_job, job, on_finish)
+
     def browse_directory(self):
         directory = tk.filedialog.askdirectory(initialdir=BASE_DIR)
         if os.path.isdir(directory):
@@ -201,6 +305,8 @@ class MainWindow(tk.Frame):
 
     def quit(self):
         self.cont = False
+        self.cancel_search()
+        self.jobs.cancel_all()
         close_window(self.master)
 
     def restart(self):
@@ -215,6 +321,7 @@ class MainWindow(tk.Frame):
         self.context_menu = ContextMenu(master, event, tearoff=0)
 
     def checkbox_click(self):
+        self.clear_term_results()
         self.lb_files_found.listbox.clicked = -1
         self.lb_previous_searches.listbox.clicked = -1
         self.previous_search_click()
@@ -224,34 +331,132 @@ class MainWindow(tk.Frame):
         if not self.search_term:
             return
         settings = self.master.settings
-        search_terms = settings['search-terms']
         listbox = self.lb_previous_searches.listbox
-        if self.search_term in search_terms:
-            search_terms.remove(self.search_term)
-            search_terms.append(self.search_term)
-            listbox.delete(0, tk.END)
-            [listbox.insert(0, term) for term in search_terms]
-        else:
-            search_terms.append(self.search_term)
-            listbox.insert(0, self.search_term)
+        size = len(settings['search-terms'])
+        previous, evicted = add_search_term(settings, self.search_term)
+        # rows are newest first, so row = size - 1 - position
+        if previous is not None:
+            listbox.delete(size - 1 - previous)
+        if evicted:
+            listbox.delete(listbox.size() - len(evicted), tk.END)
+        listbox.insert(0, self.search_term)
         listbox.select_clear(0, tk.END)
         listbox.select_set(0)
-        settings['search-terms'] = search_terms
         save_settings(settings)
         self.search(self.search_bar.get())
         self.search_bar.delete(0, tk.END)
 
     def search(self, text):
-        self.found = find(
-            self.master.settings['script-directory'], text,
-            self.var_case_sensitive.get(), self.var_regex.get()
-        )
-        self.found.reverse()
+        self.cancel_search()
         self.lb_files_found.clear()
-        for result in self.found:
-            filename, matches = result
-            count = len(matches)
-            self.lb_files_found.listbox.insert(0, f' {str(count).ljust(6)} {filename}')
+        if not self.term_results_done:
+            self.clear_term_results()  # partial counts from a cancelled run
+        dir_ = self.master.settings['script-directory']
+        if self.var_packed.get():
+            self.found = SearchResults(
+                dir_, read=lambda name: read_packed(dir_, name)
+            )
+            self.search_thread = SearchThread(
+                find_packed_iter, dir_, text,
+                self.var_case_sensitive.get(), self.var_regex.get()
+            )
+        else:
+            self.found = SearchResults(dir_)
+            self.search_thread = SearchThread(
+                find_iter, dir_, text,
+                self.var_case_sensitive.get(), self.var_regex.get(),
+                self.master.settings.get('search-workers')
+            )
+        self.search_thread.start()
+        self.after(SEARCH_POLL_MS, self.drain_search, self.search_thread)
+
+    def drain_search(self, search_thread):
+        if search_thread is not self.search_thread:
+            return  # cancelled, a newer search owns the list
+        while True:
+            try:
+                kind, value = search_thread.results.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'result':
+                filename, matches = value
+                self.found.add(filename, matches)
+                count = len(matches)
+                self.lb_files_found.listbox.insert(
+                    tk.END, f' {str(count).ljust(6)} {filename}'
+                )
+            elif kind == 'error':
+                self.set_status(f'Search failed: {value}')
+            else:
+                self.search_thread = None
+                return
+        self.after(SEARCH_POLL_MS, self.drain_search, search_thread)
+
+    def format_term(self, term):
+        if term in self.term_counts:
+            return f'{term}  ({self.term_counts[term]})'
+        return term
+
+    def clear_term_results(self):
+        if self.term_counts:
+            if not self.term_results_done:
+                self.cancel_search()  # a running search all would count into {}
+            self.term_counts = {}
+            self.term_results_done = False
+            self.lb_previous_searches.listbox.schedule_render()
+
+    def search_all(self):
+        terms = list(self.master.settings['search-terms'])
+        if not terms:
+            return
+        self.cancel_search()
+        dir_ = self.master.settings['script-directory']
+        errors = term_errors(
+            terms, self.var_case_sensitive.get(), self.var_regex.get()
+        )
+        self.term_counts = {
+            term: 'invalid' if term in errors else 0 for term in terms
+        }
+        if errors:
+            self.set_status('\n'.join(
+                f'Invalid search term {term}: {error}'
+                for term, error in errors.items()
+            ))
+        self.term_results_done = False
+        self.search_thread = SearchThread(
+            find_all_iter, dir_, terms,
+            self.var_case_sensitive.get(), self.var_regex.get(),
+            self.master.settings.get('search-workers')
+        )
+        self.search_thread.start()
+        self.after(SEARCH_POLL_MS, self.drain_search_all, self.search_thread)
+
+    def drain_search_all(self, search_thread):
+        if search_thread is not self.search_thread:
+            return
+        listbox = self.lb_previous_searches.listbox
+        while True:
+            try:
+                kind, value = search_thread.results.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'result':
+                term, filename, matches = value
+                self.term_counts[term] += len(matches)
+            elif kind == 'error':
+                self.set_status(f'Search failed: {value}')
+            else:
+                self.search_thread = None
+                self.term_results_done = True
+                listbox.schedule_render()
+                return
+        listbox.schedule_render()
+        self.after(SEARCH_POLL_MS, self.drain_search_all, search_thread)
+
+    def cancel_search(self):
+        if self.search_thread is not None:
+            self.search_thread.cancel()
+            self.search_thread = None
 
     def previous_search_click(self, *args):
         try:
@@ -273,16 +478,13 @@ class MainWindow(tk.Frame):
             return None
         if lb.clicked != sel[0]:
             lb.clicked = sel[0]
-            filename = lb.get(lb.clicked).split()[1]
-            if self.found:
-                self.lb_file_context.listbox.delete(0, tk.END)
-                for result in self.found:
-                    result_filename, matches = result
-                    if result_filename == filename:
-                        for match in matches:
-                            i, context = match
-                            text = f'{str(i).ljust(5)} {context}'
-                            self.lb_file_context.listbox.insert(0, text)
+            if lb.clicked < len(self.found):
+                # Files found rows are in the order results were added
+                filename = self.found.filenames[lb.clicked]
+                self.lb_file_context.listbox.set_items(
+                    f'{str(i).ljust(5)} {context}'
+                    for i, context in self.found.lines(filename)
+                )
 
     # -------------------------------------------------------------------
     # -------------------- C O N F I R M A T I O N S --------------------
@@ -352,6 +554,7 @@ class MainWindow(tk.Frame):
 # -----------------------------------------------
 
 def main():
+    multiprocessing.freeze_support()
     root = tk.Tk()
     root.settings = load_settings()
     root.protocol('WM_DELETE_WINDOW', lambda: close_window(root))
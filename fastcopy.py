@@ -0,0 +1,91 @@
+import errno
+import os
+import sys
+
+from collections import Counter
+from shutil import copyfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # windows
+
+
+FICLONE = 0x40049409
+# errors that mean "this filesystem/kernel can't do it", not a failed copy
+UNSUPPORTED = {
+    errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+    errno.ENOTTY, errno.EBADF, errno.EPERM
+}
+
+STRATEGIES = ['reflink', 'copy_file_range', 'sendfile', 'copyfile']
+
+# strategy -> number of files copied with it
+stats = Counter()
+# (strategy, st_dev) pairs that already failed, not tried again
+_unsupported = set()
+
+
+def reflink(infile, outfile, size):
+    fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+
+
+def copy_range(infile, outfile, size):
+    offset = 0
+    while offset < size:
+        sent = os.copy_file_range(
+            infile.fileno(), outfile.fileno(), size - offset
+        )
+        if sent == 0:
+            break
+        offset += sent
+
+
+def send(infile, outfile, size):
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(
+            outfile.fileno(), infile.fileno(), offset, size - offset
+        )
+        if sent == 0:
+            break
+        offset += sent
+
+
+KERNEL_COPIES = {
+    'reflink': (reflink, fcntl is not None and sys.platform.startswith('linux')),
+    'copy_file_range': (copy_range, hasattr(os, 'copy_file_range')),
+    'sendfile': (send, hasattr(os, 'sendfile') and sys.platform.startswith('linux')),
+}
+
+
+def copy_file(src, dst, strategies=STRATEGIES):
+    # returns the name of the strategy that did the copy
+    with open(src, 'rb') as infile:
+        stat = os.fstat(infile.fileno())
+        with open(dst, 'wb') as outfile:
+            for strategy in strategies:
+                if strategy not in KERNEL_COPIES:
+                    continue
+                func, available = KERNEL_COPIES[strategy]
+                if not available or (strategy, stat.st_dev) in _unsupported:
+                    continue
+                try:
+                    func(infile, outfile, stat.st_size)
+                except OSError as e:
+                    if e.errno not in UNSUPPORTED:
+                        raise
+                    _unsupported.add((strategy, stat.st_dev))
+                    outfile.seek(0)
+                    outfile.truncate()
+                    continue
+                if outfile.seek(0, os.SEEK_END) == stat.st_size:
+                    stats[strategy] += 1
+                    return strategy
+                outfile.seek(0)
+                outfile.truncate()
+    if 'copyfile' not in strategies:
+        raise OSError(errno.ENOTSUP, 'no copy strategy available', src)
+    copyfile(src, dst)
+    stats['copyfile'] += 1
+    return 'copyfile'
@@ -0,0 +1,59 @@
+from jobs import no_progress
+from profiler import profiled
+from snapshot import DirectorySnapshot
+
+
+@profiled(counters=dict)
+def prepare_files(dir, progress=no_progress, snapshot=None):
+    snapshot = snapshot or DirectorySnapshot(dir)
+    backups = snapshot.with_ext('.sdat', '.luabnd')
+    dcx_files = snapshot.with_ext('.dcx')
+    total = len(backups) + len(dcx_files)
+    for name in backups:
+        progress(name, total)
+        if not snapshot.is_file(name + '.bak'):
+            snapshot.rename(name, name + '.bak')
+    copied = 0
+    for name in dcx_files:
+        progress(name, total)
+        snapshot.copy(name, name + '.sdat')
+        copied += snapshot.size(name + '.sdat')
+    return {'files': total, 'bytes': copied}
+
+
+@profiled(counters=dict)
+def flip_files(dir, ext_a, ext_b, progress=no_progress, snapshot=None):
+    # both moves of a file are done together, so stopping between
+    # files never leaves a file without its .sdat
+    snapshot = snapshot or DirectorySnapshot(dir)
+    sdat_names = set(snapshot.with_ext('.sdat'))
+    b_names = {
+        name[:-len(ext_b)] for name in snapshot.with_ext(ext_b)
+        if name[:-len(ext_b)].endswith('.sdat')
+    }
+    names = sorted(sdat_names | b_names)
+    for sdat_name in names:
+        progress(sdat_name, len(names))
+        if sdat_name in sdat_names:
+            snapshot.move(sdat_name, sdat_name + ext_a)
+            # print(sdat_name, '------>', sdat_name + ext_a)
+        if sdat_name in b_names:
+            snapshot.move(sdat_name + ext_b, sdat_name)
+            # print(sdat_name + ext_b, '------>', sdat_name)
+    return {'files': len(names)}
+
+
+def reset_temporarily(dir, progress=no_progress, snapshot=None):
+    return flip_files(dir, '.modded', '.bak', progress, snapshot)
+
+
+def restore_modifications(dir, progress=no_progress, snapshot=None):
+    return flip_files(dir, '.bak', '.modded', progress, snapshot)
+
+
+def reset_permanently(dir, progress=no_progress, snapshot=None):
+    snapshot = snapshot or DirectorySnapshot(dir)
+    names = snapshot.with_ext('.bak')
+    for name in names:
+        progress(name, len(names))
+        snapshot.move(name, name[:-len('.bak')])
@@ -0,0 +1,200 @@
+import os
+import pickle
+
+from snapshot import DirectorySnapshot
+
+
+INDEX_VERSION = 2
+GRAM = 3
+
+
+def text_grams(text):
+    # casefolded runs of GRAM chars, as tuples
+    text = text.casefold()
+    return set(zip(*(text[i:] for i in range(GRAM))))
+
+
+def read_lines(path):
+    with open(path, 'r', encoding='shift_jis', errors='replace') as infile:
+        return infile.readlines()
+
+
+def decode_line(raw):
+    # same text read_lines gives for this raw line (universal newlines)
+    line = raw.decode('shift_jis', errors='replace')
+    if line.endswith('\r\n'):
+        return line[:-2] + '\n'
+    if line.endswith('\r'):
+        return line[:-1] + '\n'
+    return line
+
+
+def regex_fragments(pattern):
+    # literal runs that every match of the pattern must contain,
+    # anything that could make a run optional or alternative ends it
+    if '(?' in pattern:
+        return []
+    fragments = []
+    run = ''
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            n = pattern[i + 1:i + 2]
+            if depth == 0 and n.isascii() and n and not n.isalnum():
+                run += n
+            else:
+                fragments.append(run)
+                run = ''
+            i += 2
+            continue
+        if c == '[':
+            fragments.append(run)
+            run = ''
+            i += 1
+            if pattern[i:i + 1] == '^':
+                i += 1
+            if pattern[i:i + 1] == ']':
+                i += 1
+            while i < len(pattern) and pattern[i] != ']':
+                i += 2 if pattern[i] == '\\' else 1
+        elif c == '|':
+            if depth == 0:
+                return []
+        elif c == '(':
+            fragments.append(run)
+            run = ''
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c in '*?{':
+            fragments.append(run[:-1])
+            run = ''
+            if c == '{':
+                while i < len(pattern) and pattern[i] != '}':
+                    i += 1
+        elif c in '+.^$':
+            fragments.append(run)
+            run = ''
+        elif depth == 0 and c.isascii() and c.isprintable():
+            run += c
+        else:
+            fragments.append(run)
+            run = ''
+        i += 1
+    fragments.append(run)
+    return [f for f in fragments if len(f) >= GRAM]
+
+
+class FileIndex:
+    # per directory {filename: {'mtime', 'size', **index_file()}} of the
+    # .lua files, pickled to path and refreshed from mtime/size; shared
+    # is pickled along for state the entries of every dir refer to
+    version = INDEX_VERSION
+
+    def __init__(self, path):
+        self.path = path
+        self.dirs = {}
+        self.shared = {}
+        self.fingerprints = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as infile:
+                data = pickle.load(infile)
+            if data.get('version') == self.version:
+                self.dirs = data['dirs']
+                self.shared = data['shared']
+        except (OSError, EOFError, pickle.UnpicklingError,
+                AttributeError, KeyError, ValueError):
+            self.dirs = {}
+            self.shared = {}
+
+    def save(self):
+        if not self.dirty:
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as outfile:
+            pickle.dump(
+                {
+                    'version': self.version, 'dirs': self.dirs,
+                    'shared': self.shared
+                },
+                outfile, protocol=pickle.HIGHEST_PROTOCOL
+            )
+        os.replace(temp_path, self.path)
+        self.dirty = False
+
+    def refresh(self, dir, snapshot=None):
+        key = os.path.abspath(dir)
+        entries = self.dirs.setdefault(key, {})
+        snapshot = snapshot or DirectorySnapshot(dir)
+        seen = set()
+        for name in snapshot.with_ext('.lua'):
+            seen.add(name)
+            stat = snapshot.stat(name)
+            indexed = entries.get(name)
+            if indexed is None or indexed['mtime'] != stat.st_mtime_ns \
+                    or indexed['size'] != stat.st_size:
+                entries[name] = dict(
+                    self.index_file(snapshot.path(name)),
+                    mtime=stat.st_mtime_ns, size=stat.st_size
+                )
+                self.dirty = True
+        for filename in set(entries) - seen:
+            del entries[filename]
+            self.dirty = True
+        # changes whenever a .lua file is added, removed or touched
+        self.fingerprints[key] = hash(frozenset(
+            (name, entry['mtime'], entry['size'])
+            for name, entry in entries.items()
+        ))
+        return sorted(seen)
+
+    def index_file(self, path):
+        raise NotImplementedError
+
+
+class TrigramIndex(FileIndex):
+    # a bitset per file of the trigrams it holds, the bit numbers are
+    # handed out to trigrams as they are first seen (shared['grams']);
+    # a few KB per file where line postings took many times the script
+    def index_file(self, path):
+        with open(path, 'r', encoding='shift_jis', errors='replace') as infile:
+            grams = text_grams(infile.read())
+        numbers = self.shared.setdefault('grams', {})
+        for gram in grams - numbers.keys():
+            numbers[gram] = len(numbers)
+        bits = bytearray((len(numbers) + 7) // 8)
+        for n in map(numbers.__getitem__, grams):
+            bits[n >> 3] |= 1 << (n & 7)
+        return {'grams': bytes(bits)}
+
+    def candidates(self, dir, search_term, regex=False):
+        # filenames holding every trigram of the term, None if the term
+        # has no literal part long enough to look up
+        if regex:
+            fragments = regex_fragments(search_term)
+        elif len(search_term) >= GRAM:
+            fragments = [search_term]
+        else:
+            fragments = []
+        grams = set()
+        for fragment in fragments:
+            grams |= text_grams(fragment)
+        if not grams:
+            return None
+        numbers = self.shared.get('grams', {})
+        if not all(gram in numbers for gram in grams):
+            return set()  # a trigram no indexed file has
+        wanted = [numbers[gram] for gram in grams]
+        found = set()
+        for filename, indexed in self.dirs.get(os.path.abspath(dir), {}).items():
+            bits = indexed['grams']
+            if all(n >> 3 < len(bits) and bits[n >> 3] >> (n & 7) & 1
+                   for n in wanted):
+                found.add(filename)
+        return found
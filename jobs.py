@@ -0,0 +1,100 @@
+import os
+import queue
+import threading
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobBusy(Exception):
+    pass
+
+
+def no_progress(name, total):
+    pass
+
+
+class Job(threading.Thread):
+    # runs func(dir, *args, progress=self.progress) off the Tk thread,
+    # progress is read from self.events as ('progress', (done, total, name))
+    # followed by ('done', None) once status is 'finished', 'cancelled'
+    # or 'failed' (with the exception in self.error)
+    def __init__(self, label, func, dir, *args, on_finish=None):
+        # not a daemon: on exit the current file is finished, not cut off
+        super().__init__()
+        self.label = label
+        self.func = func
+        self.dir = dir
+        self.args = args
+        self.on_finish = on_finish
+        self.events = queue.Queue()
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.done = 0
+        self.status = 'running'
+        self.result = None
+        self.error = None
+
+    def progress(self, name, total):
+        # called by func before each file (from any of its threads),
+        # so a cancel takes effect at the next file boundary
+        if self.cancelled.is_set():
+            raise JobCancelled()
+        with self.lock:
+            self.done += 1
+            done = self.done
+        self.events.put(('progress', (done, total, name)))
+
+    def run(self):
+        try:
+            self.result = self.func(
+                self.dir, *self.args, progress=self.progress
+            )
+            self.status = 'finished'
+        except JobCancelled:
+            self.status = 'cancelled'
+        except Exception as e:
+            self.error = e
+            self.status = 'failed'
+        finally:
+            if self.on_finish is not None:
+                self.on_finish(self)
+            self.events.put(('done', None))
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+class JobScheduler:
+    # one job per script directory at a time, file operations on the
+    # same directory (flipping files while patches are generated from
+    # them, ...) would otherwise trip over each other
+    def __init__(self):
+        self.running = {}
+        self.lock = threading.Lock()
+
+    def submit(self, label, func, dir, *args):
+        key = os.path.abspath(dir)
+        with self.lock:
+            job = self.running.get(key)
+            if job is not None:
+                raise JobBusy(f'{job.label} is still running on {dir}')
+            job = Job(label, func, dir, *args, on_finish=self.finished)
+            self.running[key] = job
+        job.start()
+        return job
+
+    def finished(self, job):
+        with self.lock:
+            key = os.path.abspath(job.dir)
+            if self.running.get(key) is job:
+                del self.running[key]
+
+    def jobs(self):
+        with self.lock:
+            return list(self.running.values())
+
+    def cancel_all(self):
+        for job in self.jobs():
+            job.cancel()
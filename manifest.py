@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+HASH_CHUNK = 1 << 20
+# files modified this recently may change again within the same mtime
+# tick, their hashes are used but not remembered
+RACY_NS = 2 * 10 ** 9
+
+
+def hash_file(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    # path -> [size, mtime_ns, content hash]
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as infile:
+                self.entries = json.load(infile)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        if not self.dirty:
+            return
+        with self.lock:  # watch mode saves from its own thread
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as outfile:
+                json.dump(dict(self.entries), outfile)
+            os.replace(temp_path, self.path)
+            self.dirty = False
+
+    def digest(self, path, stat=None):
+        if stat is None:
+            stat = os.stat(path)
+        key = os.path.abspath(path)
+        entry = self.entries.get(key)
+        if entry and entry[0] == stat.st_size \
+                and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        digest = hash_file(path)
+        self.remember(key, stat, digest)
+        return digest
+
+    def remember(self, path, stat, digest):
+        key = os.path.abspath(path)
+        if time.time_ns() - stat.st_mtime_ns > RACY_NS:
+            self.entries[key] = [stat.st_size, stat.st_mtime_ns, digest]
+        else:
+            self.entries.pop(key, None)
+        self.dirty = True
+
+    def same(self, path_a, path_b, stat_a=None, stat_b=None):
+        # stat-only when both files are already known, False if b is missing;
+        # stats the caller already has (a directory snapshot) are reused
+        if stat_b is None:
+            try:
+                stat_b = os.stat(path_b)
+            except FileNotFoundError:
+                return False
+        if stat_a is None:
+            stat_a = os.stat(path_a)
+        if stat_a.st_size != stat_b.st_size:
+            return False
+        return self.digest(path_a, stat_a) == self.digest(path_b, stat_b)
+
+    def forget(self, path):
+        # path was just written: too recent to remember (RACY_NS), it is
+        # hashed again when next compared
+        if self.entries.pop(os.path.abspath(path), None) is not None:
+            self.dirty = True
@@ -0,0 +1,169 @@
+import argparse
+import json
+import os
+
+from concurrent.futures import (
+    ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+)
+from delta import PatchError, apply_patch, make_patch
+from jobs import JobCancelled, no_progress
+from profiler import profiled
+from utils import BASE_DIR, REGIONS, get_manifest
+
+
+# input hashes and stats of the last generated patch per region
+RECORD_NAME = 'patches.json'
+
+
+def sdat_name(num):
+    return f'm0{num}.luabnd.dcx.sdat'
+
+
+def patch_counters(results):
+    made = [
+        r for r in results.values()
+        if not r.get('skipped') and 'error' not in r
+    ]
+    return {
+        'files': 2 * len(made),
+        'bytes': sum(r['source'] + r['target'] for r in made),
+        'written': sum(r['patch'] for r in made),
+        'skipped': sum(1 for r in results.values() if r.get('skipped')),
+    }
+
+
+def load_record(out_dir):
+    try:
+        with open(os.path.join(out_dir, RECORD_NAME), 'r') as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_record(out_dir, record):
+    path = os.path.join(out_dir, RECORD_NAME)
+    with open(path + '.tmp', 'w') as outfile:
+        json.dump(record, outfile, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def gen_region(bak_path, sdat_path, patch_path):
+    # the old patch stays in place until the new one is complete
+    temp_path = patch_path + '.tmp'
+    try:
+        stats = make_patch(bak_path, sdat_path, temp_path)
+        os.replace(temp_path, patch_path)
+    finally:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+    return stats
+
+
+@profiled(counters=patch_counters)
+def gen_patches(dir, out_dir=BASE_DIR, progress=no_progress):
+    # regions whose .sdat.bak/.sdat hashes match the last run keep their
+    # patch, the rest are diffed in parallel processes
+    manifest = get_manifest()
+    record = load_record(out_dir)
+    results = {}
+    todo = {}
+    for num in REGIONS:
+        sdat_path = os.path.join(dir, sdat_name(num))
+        patch_path = os.path.join(out_dir, sdat_name(num) + '.patch')
+        try:
+            inputs = [
+                manifest.digest(sdat_path + '.bak'), manifest.digest(sdat_path)
+            ]
+        except FileNotFoundError:
+            results[num] = {'error': 'file not found'}
+            progress(sdat_name(num), len(REGIONS))
+            continue
+        known = record.get(sdat_name(num))
+        if known and known['inputs'] == inputs and os.path.isfile(patch_path):
+            results[num] = dict(known['stats'], skipped=True)
+            progress(sdat_name(num), len(REGIONS))
+        else:
+            todo[num] = (inputs, sdat_path + '.bak', sdat_path, patch_path)
+    try:
+        if todo:
+            with ProcessPoolExecutor(max_workers=len(todo)) as executor:
+                futures = {
+                    executor.submit(gen_region, *paths): num
+                    for num, (_, *paths) in todo.items()
+                }
+                try:
+                    for future in as_completed(futures):
+                        num = futures[future]
+                        results[num] = future.result()
+                        record[sdat_name(num)] = {
+                            'inputs': todo[num][0], 'stats': results[num]
+                        }
+                        progress(sdat_name(num), len(REGIONS))
+                except JobCancelled:
+                    for future in futures:
+                        future.cancel()
+                    raise
+    finally:
+        save_record(out_dir, record)
+        manifest.save()
+    return dict(sorted(results.items()))
+
+
+def apply_region(dir, patch_dir, num, progress=no_progress):
+    progress(sdat_name(num), len(REGIONS))
+    sdat_path = os.path.join(dir, sdat_name(num))
+    patch_path = os.path.join(patch_dir, sdat_name(num) + '.patch')
+    if not os.path.isfile(patch_path):
+        return None
+    try:
+        return apply_patch(sdat_path + '.bak', patch_path, sdat_path)
+    except (OSError, PatchError) as e:
+        return {'error': str(e)}
+
+
+def apply_patches(dir, patch_dir=BASE_DIR, progress=no_progress):
+    # regions are independent files, hashing and copying them is I/O
+    # bound so a thread per region is enough to overlap the work
+    with ThreadPoolExecutor(max_workers=len(REGIONS)) as executor:
+        results = executor.map(
+            lambda num: apply_region(dir, patch_dir, num, progress), REGIONS
+        )
+        results = dict(zip(REGIONS, results))
+    return {num: result for num, result in results.items() if result}
+
+
+def format_applied(label, results, done='applied'):
+    # results: {file name: stats or {'error'}} -> status line text
+    failed = [
+        f'{name}: {result["error"]}' for name, result in results.items()
+        if 'error' in result
+    ]
+    text = f'{label}: {len(results) - len(failed)} {done}, {len(failed)} failed'
+    return '\n'.join([text] + failed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='DeStuff patches')
+    sub = parser.add_subparsers(dest='command', required=True)
+    for command in ['make', 'apply']:
+        command_parser = sub.add_parser(command)
+        command_parser.add_argument('dir', help='script directory')
+        command_parser.add_argument('--patch-dir', default=BASE_DIR)
+    args = parser.parse_args(argv)
+    if args.command == 'make':
+        results = gen_patches(args.dir, args.patch_dir)
+        print(format_applied('make', {
+            sdat_name(num): result for num, result in results.items()
+        }, done='made'))
+    else:
+        results = apply_patches(args.dir, args.patch_dir)
+        print(format_applied('apply', {
+            sdat_name(num): result for num, result in results.items()
+        }))
+    if any('error' in result for result in results.values()):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
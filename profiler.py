@@ -0,0 +1,140 @@
+import json
+import os
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+
+MAX_RECORDS = 1000
+
+
+class Span:
+    # one timed operation, counters are summed in by add()
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+        self.counters = {}
+        self.thread = threading.get_ident()
+        self.start = time.perf_counter()
+        self.finished = False
+
+    def add(self, **counters):
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def finish(self, **counters):
+        # safe to call twice, generators finish from close() as well
+        if self.finished:
+            return
+        self.finished = True
+        self.add(**counters)
+        self.profiler.record({
+            'name': self.name,
+            'start': self.start - self.profiler.epoch,
+            'duration': time.perf_counter() - self.start,
+            'thread': self.thread,
+            'args': self.args,
+            'counters': self.counters,
+        })
+
+
+class Profiler:
+    # rolling record of the last MAX_RECORDS operations
+    def __init__(self, max_records=MAX_RECORDS):
+        self.records = deque(maxlen=max_records)
+        self.lock = threading.Lock()
+        self.epoch = time.perf_counter()
+
+    def record(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.records)
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+
+    def start(self, name, **args):
+        return Span(self, name, args)
+
+    @contextmanager
+    def span(self, name, **args):
+        span = self.start(name, **args)
+        try:
+            yield span
+        finally:
+            span.finish()
+
+    def profiled(self, name=None, counters=None):
+        # decorator, counters(result) -> {counter: value} for the span
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name or func.__name__) as span:
+                    result = func(*args, **kwargs)
+                    if counters is not None:
+                        span.add(**counters(result))
+                    return result
+            return wrapper
+        return decorator
+
+    def summary(self):
+        # name -> calls, total/mean/max/last seconds and summed counters
+        summary = {}
+        for record in self.snapshot():
+            entry = summary.setdefault(record['name'], {
+                'calls': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0,
+                'counters': {}
+            })
+            entry['calls'] += 1
+            entry['total'] += record['duration']
+            entry['max'] = max(entry['max'], record['duration'])
+            entry['last'] = record['duration']
+            for key, value in record['counters'].items():
+                entry['counters'][key] = entry['counters'].get(key, 0) + value
+        for entry in summary.values():
+            entry['mean'] = entry['total'] / entry['calls']
+        return summary
+
+    def format_summary(self):
+        lines = []
+        for name, entry in sorted(self.summary().items()):
+            lines.append(
+                f'{name}: {entry["calls"]} calls, '
+                f'mean {entry["mean"]:.3f}s, max {entry["max"]:.3f}s, '
+                f'last {entry["last"]:.3f}s'
+            )
+            for key, value in sorted(entry['counters'].items()):
+                lines.append(f'    {key}: {value}')
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        # complete ('X') events, chrome://tracing and Perfetto read these
+        pid = os.getpid()
+        return {'traceEvents': [
+            {
+                'name': record['name'], 'ph': 'X', 'pid': pid,
+                'tid': record['thread'],
+                'ts': int(record['start'] * 1e6),
+                'dur': int(record['duration'] * 1e6),
+                'args': dict(record['args'], **record['counters']),
+            }
+            for record in self.snapshot()
+        ]}
+
+    def export(self, path, trace=False):
+        data = self.chrome_trace() if trace else self.snapshot()
+        with open(path, 'w') as outfile:
+            json.dump(data, outfile, indent=1, default=str)
+
+
+profiler = Profiler()
+span = profiler.span
+profiled = profiler.profiled
@@ -0,0 +1,119 @@
+import ntpath
+import os
+
+from bnd import ArchiveError, open_archive, pack_bnd3, write_dcx
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from jobs import JobCancelled, no_progress
+from profiler import profiled
+from utils import REGIONS, update_global, update_sdat
+
+
+def archive_name(num):
+    return f'm0{num}.luabnd.dcx'
+
+
+def extract_root(dir, num):
+    return os.path.join(dir, f'm0{num}.luabnd.extract')
+
+
+def entry_path(root, name):
+    # N:\DemonsSoul\data\DVDROOT\script\x.lua -> root/DemonsSoul/.../x.lua
+    parts = ntpath.splitdrive(name)[1].strip('\\').split('\\')
+    return os.path.join(root, *parts)
+
+
+def changed_entries(archive, root):
+    # {entry index: new contents} of the extracted files that differ
+    # from the archive, entries missing from the extract dir are kept
+    changed = {}
+    for i, entry in enumerate(archive.entries):
+        if entry['name'] is None:
+            continue
+        try:
+            with open(entry_path(root, entry['name']), 'rb') as infile:
+                data = infile.read()
+        except FileNotFoundError:
+            continue
+        if data != archive.read(entry):
+            changed[i] = data
+    return changed
+
+
+def verify(path, archive, changed):
+    # read the new archive back and compare every entry with its source
+    rebuilt = open_archive(path)
+    if len(rebuilt.entries) != len(archive.entries):
+        raise ArchiveError(f'{path}: entry count changed')
+    for i, (old, new) in enumerate(zip(archive.entries, rebuilt.entries)):
+        expected = changed[i] if i in changed else archive.read(old)
+        if new['name'] != old['name'] or rebuilt.read(new) != expected:
+            raise ArchiveError(f'{path}: {old["name"]} did not read back')
+
+
+def repack_region(dir, num):
+    # rebuilds m0N.luabnd.dcx from its extract dir, None if the region
+    # isn't there and {'changed': 0} when nothing in it was edited
+    path = os.path.join(dir, archive_name(num))
+    root = extract_root(dir, num)
+    if not os.path.isfile(path) or not os.path.isdir(root):
+        return None
+    archive = open_archive(path)
+    changed = changed_entries(archive, root)
+    if not changed:
+        return {'changed': 0, 'entries': len(archive.entries), 'size': 0}
+    temp_path = path + '.tmp'
+    try:
+        data = pack_bnd3(archive, changed)
+        if archive.dcx_header is None:
+            with open(temp_path, 'wb') as outfile:
+                outfile.write(data)
+        else:
+            write_dcx(temp_path, archive.dcx_header, data)
+        verify(temp_path, archive, changed)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+    return {
+        'changed': len(changed), 'entries': len(archive.entries),
+        'size': os.path.getsize(path)
+    }
+
+
+def repack_counters(results):
+    return {
+        'files': sum(r['changed'] for r in results.values()),
+        'written': sum(r['size'] for r in results.values()),
+    }
+
+
+@profiled(counters=repack_counters)
+def repack(dir, regions=REGIONS, progress=no_progress):
+    # regions are deflated in parallel processes, a cancel stops the
+    # regions that haven't started yet
+    results = {}
+    with ProcessPoolExecutor(max_workers=len(regions)) as executor:
+        futures = {
+            executor.submit(repack_region, dir, num): num for num in regions
+        }
+        try:
+            for future in as_completed(futures):
+                num = futures[future]
+                result = future.result()
+                if result is not None:
+                    results[num] = result
+                progress(archive_name(num), len(regions))
+        except JobCancelled:
+            for future in futures:
+                future.cancel()
+            raise
+    return dict(sorted(results.items()))
+
+
+def build(dir, progress=no_progress):
+    # edited base dir .lua files -> extract dirs -> archives -> .sdat
+    return {
+        'update_global': update_global(dir),
+        'repack': repack(dir, progress=progress),
+        'update_sdat': update_sdat(dir),
+    }
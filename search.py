@@ -0,0 +1,478 @@
+import io
+import os
+import queue
+import re
+import threading
+
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import accumulate, compress
+
+from delta import open_map
+from index import decode_line, regex_fragments
+
+
+# below this much script text a pool costs more than it saves
+PARALLEL_MIN_BYTES = 1 << 20
+CHUNKS_PER_WORKER = 16
+# a needle hitting more than once per DENSE_BYTES of script is faster to
+# look for in the whole decoded file than hit by hit
+DENSE_BYTES = 256
+
+
+@lru_cache(maxsize=16)
+def compile_matcher(search_term, case_sensitive=False, regex=False):
+    if regex:
+        flags = 0 if case_sensitive else re.IGNORECASE
+        return re.compile(search_term, flags).search
+    if case_sensitive:
+        return lambda line: search_term in line
+    search_term = search_term.lower()
+    return lambda line: search_term in line.lower()
+
+
+class FileMatches:
+    # matched lines of one file, the text is read back from the file
+    # when it is shown instead of being kept per match
+    __slots__ = ('line_nos', 'offsets', 'lengths')
+
+    def __init__(self):
+        self.line_nos = array('I')
+        self.offsets = array('Q')
+        self.lengths = array('I')
+
+    def __len__(self):
+        return len(self.line_nos)
+
+    def add(self, line_no, offset, length):
+        self.line_nos.append(line_no)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+
+    def add_lines(self, hits, raw_lines, offsets):
+        # hits: line indexes into raw_lines, offsets: start of each line
+        self.line_nos.extend(map((1).__add__, hits))
+        self.offsets.extend(map(offsets.__getitem__, hits))
+        self.lengths.extend(map(len, map(raw_lines.__getitem__, hits)))
+
+    def lines(self, path):
+        # [(line_no, line)] in file order
+        lines = []
+        with open(path, 'rb') as infile:
+            for line_no, offset, length in zip(
+                    self.line_nos, self.offsets, self.lengths):
+                infile.seek(offset)
+                lines.append((line_no, decode_line(infile.read(length))))
+        return lines
+
+    def lines_in(self, data):
+        # same as lines() for file contents already in memory
+        return [
+            (line_no, decode_line(data[offset:offset + length]))
+            for line_no, offset, length in zip(
+                self.line_nos, self.offsets, self.lengths)
+        ]
+
+
+class SearchResults:
+    # filename -> FileMatches, filenames keeps the order files were found in;
+    # read(filename) -> bytes, for results that aren't files in dir
+    def __init__(self, dir, read=None):
+        self.dir = dir
+        self.read = read
+        self.entries = {}
+        self.filenames = []
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __iter__(self):
+        return iter(self.filenames)
+
+    def __contains__(self, filename):
+        return filename in self.entries
+
+    def add(self, filename, matches):
+        if filename not in self.entries:
+            self.filenames.append(filename)
+        self.entries[filename] = matches
+
+    def count(self, filename):
+        return len(self.entries[filename])
+
+    def lines(self, filename):
+        if self.read is not None:
+            return self.entries[filename].lines_in(self.read(filename))
+        return self.entries[filename].lines(os.path.join(self.dir, filename))
+
+
+class Needle:
+    # bytes every matching line must contain in its shift_jis form;
+    # without case sensitivity both sides are ASCII lowered, which is
+    # byte safe as the matcher checks the decoded line afterwards
+    __slots__ = ('raw', 'case_sensitive')
+
+    def __init__(self, raw, case_sensitive):
+        self.raw = raw if case_sensitive else raw.lower()
+        self.case_sensitive = case_sensitive
+
+    def haystack(self, data):
+        return data if self.case_sensitive else bytes(data).lower()
+
+    def hits(self, haystack, limit=None):
+        # start of each hit, stops after limit hits
+        step = len(self.raw)
+        i = haystack.find(self.raw)
+        while i >= 0 and limit != 0:
+            yield i
+            if limit is not None:
+                limit -= 1
+            i = haystack.find(self.raw, i + step)
+
+    def count(self, haystack, limit):
+        # hits, or at least limit + 1 of them when there are more
+        if isinstance(haystack, bytes):
+            return haystack.count(self.raw)
+        return sum(1 for _ in self.hits(haystack, limit + 1))
+
+
+@lru_cache(maxsize=16)
+def compile_needle(search_term, case_sensitive=False, regex=False):
+    # Needle for the term, None when it can't be looked for at the
+    # byte level
+    if regex:
+        fragments = regex_fragments(search_term)
+        if not fragments:
+            return None
+        raw = max(fragments, key=len).encode('ascii')
+    else:
+        if not case_sensitive and not search_term.isascii():
+            return None  # only ASCII case folding is byte safe
+        try:
+            raw = search_term.encode('shift_jis')
+        except UnicodeEncodeError:
+            return None
+        if not raw or raw.decode('shift_jis') != search_term:
+            return None
+    return Needle(raw, case_sensitive)
+
+
+def count_breaks(data):
+    return data.count(b'\n') + data.count(b'\r') - data.count(b'\r\n')
+
+
+def line_bounds(data, start, end):
+    line_start = max(data.rfind(b'\n', 0, start), data.rfind(b'\r', 0, start)) + 1
+    ends = [i for i in (data.find(b'\n', end), data.find(b'\r', end)) if i >= 0]
+    if not ends:
+        return line_start, len(data)
+    line_end = min(ends)
+    if data[line_end:line_end + 2] == b'\r\n':
+        return line_start, line_end + 2
+    return line_start, line_end + 1
+
+
+def search_bytes(data, haystack, needle, matcher, candidate_lines=None):
+    # only lines holding a needle hit are decoded, hits that start on
+    # a shift_jis trail byte are weeded out by the matcher on the text
+    matches = FileMatches()
+    line_no = 1
+    counted = 0
+    line_end = 0
+    for start in needle.hits(haystack):
+        if start < line_end:
+            continue  # another hit on a line already checked
+        line_start, line_end = line_bounds(
+            haystack, start, start + len(needle.raw)
+        )
+        line_no += count_breaks(haystack[counted:line_start])
+        counted = line_start
+        if candidate_lines is not None and line_no - 1 not in candidate_lines:
+            continue
+        if matcher(decode_line(data[line_start:line_end])):
+            matches.add(line_no, line_start, line_end - line_start)
+    return matches
+
+
+def decoded_lines(data):
+    # -> raw lines, lines; the file is decoded in one go the way read_lines
+    # does, a shift_jis trail byte is never \r or \n so the two splits
+    # line up unless the text holds something odd
+    data = bytes(data)
+    raw_lines = data.splitlines(keepends=True)
+    lines = io.StringIO(
+        data.decode('shift_jis', errors='replace'), newline=None
+    ).readlines()
+    if len(lines) != len(raw_lines):
+        lines = [decode_line(raw) for raw in raw_lines]
+    return raw_lines, lines
+
+
+def line_offsets(raw_lines):
+    return list(accumulate(map(len, raw_lines), initial=0))
+
+
+def search_text(data, matcher, candidate_lines=None):
+    # the whole file is decoded and matched line by line, the loops
+    # themselves run in C
+    raw_lines, lines = decoded_lines(data)
+    if candidate_lines is None:
+        hits = list(compress(range(len(lines)), map(matcher, lines)))
+    else:
+        indexes = [i for i in sorted(candidate_lines) if i < len(lines)]
+        hits = list(compress(
+            indexes, map(matcher, map(lines.__getitem__, indexes))
+        ))
+    matches = FileMatches()
+    matches.add_lines(hits, raw_lines, line_offsets(raw_lines))
+    return matches
+
+
+def results_size(results):
+    # rough bytes held by [(filename, FileMatches)]
+    size = 0
+    for filename, matches in results:
+        size += 200 + len(filename) + len(matches) * 20
+    return size
+
+
+class ResultCache:
+    # LRU of finished searches, evicted by estimated size; keys carry the
+    # directory fingerprint so any .lua change makes old entries unreachable
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            results = self.entries.get(key)
+            if results is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return results[0]
+
+    def put(self, key, results):
+        size = results_size(results)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (results, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+def search_data(data, matcher, candidate_lines=None, needle=None):
+    # the needle skips files without a hit and leaves only the hit lines
+    # to decode, which pays off as long as it hits rarely
+    if needle is None:
+        return search_text(data, matcher, candidate_lines)
+    haystack = needle.haystack(data)
+    limit = len(data) // DENSE_BYTES + 1
+    hits = needle.count(haystack, limit)
+    if not hits:
+        return FileMatches()
+    if hits > limit:
+        return search_text(data, matcher, candidate_lines)
+    return search_bytes(data, haystack, needle, matcher, candidate_lines)
+
+
+def search_file(path, matcher, candidate_lines=None, needle=None):
+    if needle is None:
+        with open(path, 'rb') as infile:
+            return search_text(infile.read(), matcher, candidate_lines)
+    with open_map(path) as data:
+        return search_data(data, matcher, candidate_lines, needle)
+
+
+def search_entries(entries, search_term, case_sensitive=False, regex=False,
+                   cancelled=None):
+    # entries: iterable of (name, bytes) -> (name, FileMatches) with hits
+    matcher = compile_matcher(search_term, case_sensitive, regex)
+    needle = compile_needle(search_term, case_sensitive, regex)
+    for name, data in entries:
+        if cancelled is not None and cancelled.is_set():
+            return
+        matches = search_data(data, matcher, None, needle)
+        if matches:
+            yield name, matches
+
+
+def search_chunk(dir, tasks, search_term, case_sensitive, regex):
+    matcher = compile_matcher(search_term, case_sensitive, regex)
+    needle = compile_needle(search_term, case_sensitive, regex)
+    found = []
+    for filename, candidate_lines in tasks:
+        matches = search_file(
+            os.path.join(dir, filename), matcher, candidate_lines, needle
+        )
+        if matches:
+            found.append((filename, matches))
+    return found
+
+
+def term_errors(terms, case_sensitive=False, regex=False):
+    # {term: message} of the terms that don't compile on their own
+    errors = {}
+    for term in terms:
+        try:
+            compile_matcher(term, case_sensitive, regex)
+        except re.error as e:
+            errors[term] = str(e)
+    return errors
+
+
+def combinable(term):
+    # inline flags and group references change meaning inside a bigger
+    # pattern, such terms are matched on their own
+    return '(?' not in term and not re.search(r'\\[1-9]', term)
+
+
+def compile_multi(terms, case_sensitive=False, regex=False):
+    # one alternation to find lines that hold any term, the per-term
+    # matchers then sort those lines out by term; terms must compile
+    matchers = [
+        compile_matcher(term, case_sensitive, regex) for term in terms
+    ]
+    if not regex:
+        parts, alone = [re.escape(term) for term in terms], []
+    else:
+        parts = [f'(?:{term})' for term in terms if combinable(term)]
+        alone = [
+            matcher for term, matcher in zip(terms, matchers)
+            if not combinable(term)
+        ]
+    flags = 0 if case_sensitive else re.IGNORECASE
+    if parts:
+        alone.insert(0, re.compile('|'.join(parts), flags).search)
+    if len(alone) == 1:
+        return alone[0], matchers
+    return lambda line: any(matcher(line) for matcher in alone), matchers
+
+
+def search_chunk_multi(dir, tasks, terms, case_sensitive, regex):
+    combined, matchers = compile_multi(terms, case_sensitive, regex)
+    found = []
+    for filename, _ in tasks:
+        with open(os.path.join(dir, filename), 'rb') as infile:
+            data = infile.read()
+        per_term = [FileMatches() for _ in terms]
+        raw_lines, lines = decoded_lines(data)
+        offsets = line_offsets(raw_lines)
+        for i in compress(range(len(lines)), map(combined, lines)):
+            for matches, matcher in zip(per_term, matchers):
+                if matcher(lines[i]):
+                    matches.add(i + 1, offsets[i], len(raw_lines[i]))
+        for term, matches in zip(terms, per_term):
+            if matches:
+                found.append((term, filename, matches))
+    return found
+
+
+def split(tasks, count):
+    size = -(-len(tasks) // count)
+    return [tasks[i:i + size] for i in range(0, len(tasks), size)]
+
+
+class SearchEngine:
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = None
+
+    def pool(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self.executor
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def run_chunks(self, func, dir, tasks, args, cancelled=None):
+        # yields func's per-file results as chunks finish, stops at the
+        # next file/chunk boundary once cancelled is set
+        if cancelled is None:
+            cancelled = threading.Event()
+        size = sum(os.path.getsize(os.path.join(dir, f)) for f, _ in tasks)
+        if self.workers < 2 or len(tasks) < 2 or size < PARALLEL_MIN_BYTES:
+            for task in tasks:
+                if cancelled.is_set():
+                    return
+                yield from func(dir, [task], *args)
+            return
+        chunks = split(tasks, self.workers * CHUNKS_PER_WORKER)
+        futures = [
+            self.pool().submit(func, dir, chunk, *args) for chunk in chunks
+        ]
+        try:
+            for future in as_completed(futures):
+                if cancelled.is_set():
+                    return
+                yield from future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def iter_search(self, dir, tasks, search_term, case_sensitive=False,
+                    regex=False, cancelled=None):
+        # tasks: [(filename, candidate line indexes or None)]
+        # -> (filename, FileMatches) as files are matched
+        compile_matcher(search_term, case_sensitive, regex)  # fail fast
+        return self.run_chunks(
+            search_chunk, dir, tasks,
+            (search_term, case_sensitive, regex), cancelled
+        )
+
+    def iter_search_all(self, dir, filenames, terms, case_sensitive=False,
+                        regex=False, cancelled=None):
+        # every term in one pass over the files
+        # -> (term, filename, FileMatches) as files are matched
+        compile_multi(terms, case_sensitive, regex)  # fail fast
+        return self.run_chunks(
+            search_chunk_multi, dir, [(f, None) for f in filenames],
+            (tuple(terms), case_sensitive, regex), cancelled
+        )
+
+
+class SearchThread(threading.Thread):
+    # runs a result generator off the Tk thread, results are read
+    # from self.results as ('result', value), ('error', exc), ('done', None)
+    def __init__(self, func, *args, **kwargs):
+        super().__init__(daemon=True)
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.results = queue.Queue()
+        self.cancelled = threading.Event()
+
+    def run(self):
+        try:
+            for result in self.func(
+                    *self.args, cancelled=self.cancelled, **self.kwargs):
+                if self.cancelled.is_set():
+                    break
+                self.results.put(('result', result))
+        except Exception as e:
+            self.results.put(('error', e))
+        finally:
+            self.results.put(('done', None))
+
+    def cancel(self):
+        self.cancelled.set()
@@ -0,0 +1,121 @@
+import os
+
+from fastcopy import copy_file
+from shutil import move
+
+
+def chained_suffix(name):
+    # m01.luabnd.dcx.sdat.bak -> .luabnd.dcx.sdat.bak
+    i = name.find('.', 1)
+    return name[i:] if i > 0 else ''
+
+
+class SnapshotEntry:
+    # stat is taken lazily and kept, scandir already has it on Windows
+    __slots__ = ('path', 'is_file', 'dir_entry', 'stat_result')
+
+    def __init__(self, path, is_file, dir_entry=None, stat_result=None):
+        self.path = path
+        self.is_file = is_file
+        self.dir_entry = dir_entry
+        self.stat_result = stat_result
+
+    def stat(self):
+        if self.stat_result is None:
+            if self.dir_entry is not None:
+                self.stat_result = self.dir_entry.stat()
+            else:
+                self.stat_result = os.stat(self.path)
+        return self.stat_result
+
+
+class DirectorySnapshot:
+    # one scandir of dir, grouped by extension and chained suffix; file
+    # operations done through it keep it current, so the steps of an
+    # operation see each other's moves without listing the dir again
+    def __init__(self, dir):
+        self.dir = dir
+        self.entries = {}
+        self.by_ext = {}
+        self.by_suffix = {}
+        self.scan()
+
+    def scan(self):
+        self.entries = {}
+        self.by_ext = {}
+        self.by_suffix = {}
+        with os.scandir(self.dir) as it:
+            for entry in it:
+                self.add(entry.name, SnapshotEntry(
+                    entry.path, entry.is_file(), dir_entry=entry
+                ))
+
+    def add(self, name, entry):
+        if name in self.entries:
+            self.discard(name)
+        self.entries[name] = entry
+        self.by_ext.setdefault(os.path.splitext(name)[1], set()).add(name)
+        self.by_suffix.setdefault(chained_suffix(name), set()).add(name)
+
+    def discard(self, name):
+        if self.entries.pop(name, None) is not None:
+            self.by_ext[os.path.splitext(name)[1]].discard(name)
+            self.by_suffix[chained_suffix(name)].discard(name)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def is_file(self, name):
+        entry = self.entries.get(name)
+        return entry is not None and entry.is_file
+
+    def stat(self, name):
+        return self.entries[name].stat()
+
+    def size(self, name):
+        return self.stat(name).st_size
+
+    def files(self, names):
+        return sorted(name for name in names if self.entries[name].is_file)
+
+    def with_ext(self, *exts):
+        # sorted files whose last extension is one of exts
+        return self.files(
+            name for ext in exts for name in self.by_ext.get(ext, ())
+        )
+
+    def with_suffix(self, suffix):
+        return self.files(self.by_suffix.get(suffix, ()))
+
+    def changed(self, name):
+        # name was written outside the snapshot, stat it again when asked
+        path = self.path(name)
+        if os.path.exists(path):
+            self.add(name, SnapshotEntry(path, os.path.isfile(path)))
+        else:
+            self.discard(name)
+
+    def rename(self, src, dst):
+        os.rename(self.path(src), self.path(dst))
+        self.moved(src, dst)
+
+    def move(self, src, dst):
+        move(self.path(src), self.path(dst))
+        self.moved(src, dst)
+
+    def moved(self, src, dst):
+        # size and mtime survive a rename, the cached stat is kept
+        entry = self.entries[src]
+        self.discard(src)
+        self.add(dst, SnapshotEntry(
+            self.path(dst), entry.is_file, stat_result=entry.stat_result
+        ))
+
+    def copy(self, src, dst):
+        strategy = copy_file(self.path(src), self.path(dst))
+        self.changed(dst)
+        return strategy
+
+    def remove(self, name):
+        os.remove(self.path(name))
+        self.discard(name)
@@ -1,11 +1,17 @@
 import json
 import os
-import re
 import sys
-import time
+import threading
 
-from filecmp import cmp
-from shutil import copyfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from fastcopy import copy_file
+from index import TrigramIndex
+from jobs import no_progress
+from manifest import Manifest
+from profiler import profiled, profiler
+from snapshot import DirectorySnapshot
+from xref import XrefIndex
 
 
 class DirCheckException(Exception):
@@ -13,6 +19,27 @@ class DirCheckException(Exception):
 
 
 BASE_DIR = os.path.dirname(sys.argv[0])
+REGIONS = [1, 2, 3, 4, 5, 6, 8]
+UPDATE_WORKERS = 8
+RESULT_CACHE_BYTES = 64 << 20
+ARCHIVE_CACHE_SIZE = 8
+PACKED_SUFFIX = '.luabnd.dcx'
+SETTINGS_DEBOUNCE = 1.0
+INDEX_SAVE_DEBOUNCE = 5.0
+MAX_SEARCH_TERMS = 200
+
+_settings_pending = None
+_settings_timer = None
+_settings_lock = threading.Lock()
+_index = None
+_index_lock = threading.Lock()
+_index_timer = None
+_xref = None
+_engine = None
+_cache = None
+_archives = OrderedDict()
+_archive_lock = threading.Lock()
+_manifest = None
 
 
 def config_grids(widget, rows=None, columns=None):
@@ -24,18 +51,6 @@ def config_grids(widget, rows=None, columns=None):
     [widget.columnconfigure(i, weight=w) for i, w in enumerate(columns)]
 
 
-def time_this(func):
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        duration = end_time - start_time
-        dur_str = '{:.2f}'.format(duration)
-        print(f'function: {func.__name__}() executed in {dur_str} seconds')
-        return result
-    return wrapper
-
-
 def load_settings():
     filepath = os.path.join(BASE_DIR, 'destuff.json')
     if os.path.isfile(filepath):
@@ -54,17 +69,61 @@ def load_settings():
             },
             'script-directory': '',
             'search-terms': [],
+            'search-history': MAX_SEARCH_TERMS,
+            'search-workers': 0,
             'desbndbuild': ''
         }
-        save_settings(settings)
+        write_settings(json.dumps(settings))
     return settings
 
 
+def write_settings(text):
+    # temp file + rename so a crash mid-write never truncates destuff.json
+    filepath = os.path.join(BASE_DIR, 'destuff.json')
+    temp_path = filepath + '.tmp'
+    with open(temp_path, 'w') as settings_file:
+        settings_file.write(text)
+    os.replace(temp_path, filepath)
+
+
 def save_settings(settings):
     # raise DirCheckException(BASE_DIR)
-    filepath = os.path.join(BASE_DIR, 'destuff.json')
-    with open(filepath, 'w+') as settings_file:
-        json.dump(settings, settings_file)
+    # serialized now, written once no other save came in for
+    # SETTINGS_DEBOUNCE seconds
+    global _settings_pending, _settings_timer
+    with _settings_lock:
+        _settings_pending = json.dumps(settings)
+        if _settings_timer is not None:
+            _settings_timer.cancel()
+        _settings_timer = threading.Timer(SETTINGS_DEBOUNCE, flush_settings)
+        _settings_timer.daemon = True
+        _settings_timer.start()
+
+
+def flush_settings():
+    global _settings_pending, _settings_timer
+    with _settings_lock:
+        if _settings_timer is not None:
+            _settings_timer.cancel()
+            _settings_timer = None
+        if _settings_pending is not None:
+            write_settings(_settings_pending)
+            _settings_pending = None
+
+
+def add_search_term(settings, search_term):
+    # moves/adds search_term to the end (most recent) of the history,
+    # returns its previous position (or None) and the evicted terms
+    search_terms = settings['search-terms']
+    previous = None
+    if search_term in search_terms:
+        previous = search_terms.index(search_term)
+        del search_terms[previous]
+    search_terms.append(search_term)
+    limit = max(1, settings.get('search-history', MAX_SEARCH_TERMS))
+    evicted = search_terms[:-limit]
+    del search_terms[:-limit]
+    return previous, evicted
 
 
 def get_geometry(settings):
@@ -93,86 +152,389 @@ def close_window(root):
         'y': y
     })
     save_settings(root.settings)
+    flush_settings()
+    save_indexes()
+    shutdown_engine()
     root.destroy()
 
 
-def update_global(dir):
-    nums = [1, 2, 3, 4, 5, 6, 8]
-    for num in nums:
-        extract_dir = os.path.join(
-            dir, fr'm0{num}.luabnd.extract\DemonsSoul\data\DVDROOT\script'
+def get_manifest():
+    global _manifest
+    if _manifest is None:
+        _manifest = Manifest(os.path.join(BASE_DIR, 'destuff.manifest'))
+    return _manifest
+
+
+def extract_dir(dir, num):
+    return os.path.join(
+        dir, fr'm0{num}.luabnd.extract\DemonsSoul\data\DVDROOT\script'
+    )
+
+
+def extract_dirs(dir):
+    for num in REGIONS:
+        if os.path.isdir(extract_dir(dir, num)):
+            yield extract_dir(dir, num)
+
+
+def sync_file(manifest, src, dst, results, stat_src=None, stat_dst=None):
+    try:
+        if manifest.same(src, dst, stat_src, stat_dst):
+            results['skipped'] += 1
+        else:
+            copy_file(src, dst)
+            manifest.forget(dst)
+            results['copied'] += 1
+            results['bytes'] += os.path.getsize(dst)
+    except OSError as e:
+        results['failed'] += 1
+        results['errors'].append(f'{dst}: {e}')
+
+
+def new_results():
+    return {'copied': 0, 'skipped': 0, 'failed': 0, 'bytes': 0, 'errors': []}
+
+
+def update_counters(results):
+    # skipped files were found identical through the manifest
+    return {
+        'files': results['copied'] + results['skipped'] + results['failed'],
+        'copied': results['copied'],
+        'bytes': results['bytes'],
+        'cache_hits': results['skipped'],
+    }
+
+
+def merge_results(results):
+    total = new_results()
+    for result in results:
+        for key, value in result.items():
+            total[key] += value
+    return total
+
+
+def run_tasks(func, tasks):
+    # regions/files are independent and I/O bound, so a small thread
+    # pool overlaps them; each task returns its own results dict
+    tasks = list(tasks)
+    if not tasks:
+        return new_results()
+    workers = min(len(tasks), UPDATE_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return merge_results(executor.map(func, tasks))
+
+
+def update_region(dir, extract_dir, files, manifest):
+    results = new_results()
+    if files is None:
+        files_ = os.listdir(extract_dir)
+        lua_files = [f for f in files_ if os.path.splitext(f)[1] == '.lua']
+    else:
+        lua_files = [
+            f for f in files if os.path.isfile(os.path.join(extract_dir, f))
+        ]
+    for file in lua_files:
+        main_path = os.path.join(dir, file)
+        if os.path.isfile(main_path):
+            sync_file(
+                manifest, main_path, os.path.join(extract_dir, file), results
+            )
+    return results
+
+
+@profiled(counters=update_counters)
+def update_global(dir, files=None, progress=no_progress):
+    # files limits the update to those base dir filenames (watch mode)
+    manifest = get_manifest()
+    dirs = list(extract_dirs(dir))
+
+    def update_dir(extract_dir):
+        progress(os.path.basename(extract_dir), len(dirs))
+        return update_region(dir, extract_dir, files, manifest)
+
+    results = run_tasks(update_dir, dirs)
+    manifest.save()
+    return results
+
+
+@profiled(counters=update_counters)
+def update_sdat(dir, progress=no_progress, snapshot=None):
+    manifest = get_manifest()
+    snapshot = snapshot or DirectorySnapshot(dir)
+    dcx_files = snapshot.with_ext('.dcx')
+
+    def update_file(file):
+        progress(file, len(dcx_files))
+        results = new_results()
+        sdat = file + '.sdat'
+        sync_file(
+            manifest, snapshot.path(file), snapshot.path(sdat), results,
+            snapshot.stat(file),
+            snapshot.stat(sdat) if snapshot.is_file(sdat) else None
         )
-        if os.path.isdir(extract_dir):
-            files = os.listdir(extract_dir)
-            lua_files = [f for f in files if os.path.splitext(f)[1] == '.lua']
-            for file in lua_files:
-                main_path = os.path.join(dir, file)
-                if os.path.isfile(main_path):
-                    extract_path = os.path.join(extract_dir, file)
-                    if not os.path.isfile(extract_path) \
-                            or not cmp(main_path, extract_path, shallow=False):
-                        copyfile(main_path, extract_path)
-
-
-def update_sdat(dir):
-    files = os.listdir(dir)
-    dcx_files = [f for f in files if os.path.splitext(f)[1] == '.dcx']
+        return results
+
+    results = run_tasks(update_file, dcx_files)
     for file in dcx_files:
-        dcx_path = os.path.join(dir, file)
-        sdat_path = dcx_path + '.sdat'
-        if not os.path.isfile(sdat_path) \
-                or not cmp(dcx_path, sdat_path, shallow=False):
-            copyfile(dcx_path, sdat_path)
-
-
-def reset_permanently(dir):
-    files = os.listdir(dir)
-    files = [os.path.join(dir, f) for f in files]
-    [os.remove(f) for f in files if os.path.splitext(f)[1] == '.sdat']
-    for filepath in files:
-        _, ext = os.path.splitext(filepath)
-        if ext == '.bak':
-            restored = filepath.replace('.bak', '')
-            if os.path.isfile(restored):
-                os.remove(filepath)
-            else:
-                os.rename(filepath, restored)
-
-
-# @time_this
-def find(dir, search_term, case_sensitive=False, regex=False):
-    # ['m02_00_00_00.lua', ['line1', 'line2']]
+        snapshot.changed(file + '.sdat')
+    manifest.save()
+    return results
+
+
+def format_results(label, results):
+    text = '{}: {} copied, {} skipped, {} failed'.format(
+        label, results['copied'], results['skipped'], results['failed']
+    )
+    return '\n'.join([text] + results['errors'])
+
+
+def reset_permanently(dir, snapshot=None):
+    snapshot = snapshot or DirectorySnapshot(dir)
+    for name in snapshot.with_ext('.sdat'):
+        snapshot.remove(name)
+    for name in snapshot.with_ext('.bak'):
+        restored = name[:-len('.bak')]
+        if snapshot.is_file(restored):
+            snapshot.remove(name)
+        else:
+            snapshot.rename(name, restored)
+
+
+def get_index():
+    global _index
+    if _index is None:
+        _index = TrigramIndex(os.path.join(BASE_DIR, 'destuff.index'))
+    return _index
+
+
+def schedule_index_save():
+    # called with _index_lock held; pickling a big index takes seconds,
+    # so indexes are written from a timer once searches have been quiet for
+    # INDEX_SAVE_DEBOUNCE seconds instead of before the next search
+    global _index_timer
+    if _index_timer is not None:
+        _index_timer.cancel()
+    _index_timer = threading.Timer(INDEX_SAVE_DEBOUNCE, save_indexes)
+    _index_timer.daemon = True
+    _index_timer.start()
+
+
+def save_indexes():
+    global _index_timer
+    with _index_lock:
+        if _index_timer is not None:
+            _index_timer.cancel()
+            _index_timer = None
+        if _index is not None:
+            _index.save()
+        if _xref is not None:
+            _xref.save()
+
+
+def get_xref(dir):
+    global _xref
+    with _index_lock:
+        if _xref is None:
+            _xref = XrefIndex(os.path.join(BASE_DIR, 'destuff.xref'))
+        _xref.refresh(dir)
+        if _xref.dirty:
+            schedule_index_save()
+    return _xref
+
+
+def get_engine(workers=None):
+    from search import SearchEngine  # pulls in multiprocessing
+    global _engine
+    if _engine is None or (workers and _engine.workers != workers):
+        shutdown_engine()
+        _engine = SearchEngine(workers)
+    return _engine
+
+
+def shutdown_engine():
+    global _engine
+    if _engine is not None:
+        _engine.shutdown()
+        _engine = None
+
+
+def get_cache():
+    from search import ResultCache
+    global _cache
+    if _cache is None:
+        _cache = ResultCache(RESULT_CACHE_BYTES)
+    return _cache
+
+
+def cached(results, cache, key, cancelled):
+    # passes results through, caching them if the search ran to the end
     found = []
-    files = []
-    for f in os.listdir(dir):
-        if os.path.isfile(os.path.join(dir, f)) \
-                and os.path.splitext(f)[1] == '.lua':
-            files.append(os.path.join(dir, f))
-    for file in files:
-        lines_found = []
-        filename = os.path.split(file)[1]
-        text = open(
-            file, 'r', encoding='shift_jis', errors='replace'
-        ).readlines()
-        for i, line in enumerate(text):
-            if regex:
-                if case_sensitive:
-                    results = re.findall(search_term, line)
-                else:
-                    results = re.findall(search_term, line, re.IGNORECASE)
-                if results:
-                    lines_found.append((i + 1, line))
-            else:
-                temp_line = line
-                if not case_sensitive:
-                    temp_line = line.lower()
-                    search_term = search_term.lower()
-                if search_term in temp_line:
-                    lines_found.append((i + 1, line))
-        if lines_found:
-            lines_found.reverse()
-            found.append((filename, lines_found))
-    return found
+    for result in results:
+        found.append(result)
+        yield result
+    if cancelled is None or not cancelled.is_set():
+        cache.put(key, found)
+
+
+def timed(results, span, count):
+    # the span covers the search up to its last result being consumed
+    matches = 0
+    try:
+        for result in results:
+            matches += count(result)
+            yield result
+    finally:
+        span.finish(matches=matches)
+
+
+def scanned_bytes(index, dir, filenames):
+    entries = index.dirs[os.path.abspath(dir)]
+    return sum(entries[filename]['size'] for filename in filenames)
+
+
+def find_iter(dir, search_term, case_sensitive=False, regex=False,
+              workers=None, cancelled=None):
+    span = profiler.start(
+        'find', term=search_term, case_sensitive=bool(case_sensitive),
+        regex=bool(regex)
+    )
+    with _index_lock:
+        index = get_index()
+        filenames = index.refresh(dir)
+        if index.dirty:
+            schedule_index_save()
+        key = (
+            os.path.abspath(dir), index.fingerprints[os.path.abspath(dir)],
+            search_term, bool(case_sensitive), bool(regex)
+        )
+        cache = get_cache()
+        results = cache.get(key)
+        if results is not None:
+            span.add(files=0, bytes=0, cache_hits=1)
+            return timed(iter(results), span, lambda r: len(r[1]))
+        candidates = index.candidates(dir, search_term, regex)
+        engine = get_engine(workers)
+        tasks = [
+            (filename, None) for filename in filenames
+            if candidates is None or filename in candidates
+        ]
+        span.add(
+            files=len(tasks), cache_hits=0,
+            bytes=scanned_bytes(index, dir, [f for f, _ in tasks])
+        )
+    results = engine.iter_search(
+        dir, tasks, search_term, case_sensitive, regex, cancelled
+    )
+    return timed(
+        cached(results, cache, key, cancelled), span, lambda r: len(r[1])
+    )
+
+
+def find_all_iter(dir, search_terms, case_sensitive=False, regex=False,
+                  workers=None, cancelled=None):
+    from search import term_errors
+    # terms that don't compile are left out, see term_errors
+    errors = term_errors(search_terms, case_sensitive, regex)
+    search_terms = [term for term in search_terms if term not in errors]
+    span = profiler.start('find_all', terms=len(search_terms))
+    with _index_lock:
+        index = get_index()
+        filenames = index.refresh(dir)
+        if index.dirty:
+            schedule_index_save()
+        engine = get_engine(workers)
+        fingerprint = index.fingerprints[os.path.abspath(dir)]
+        span.add(
+            files=len(filenames), bytes=scanned_bytes(index, dir, filenames)
+        )
+    results = engine.iter_search_all(
+        dir, filenames, search_terms, case_sensitive, regex, cancelled
+    )
+    results = cache_all(
+        results, (os.path.abspath(dir), fingerprint), search_terms,
+        (bool(case_sensitive), bool(regex)), cancelled
+    )
+    return timed(results, span, lambda r: len(r[2]))
+
+
+def cache_all(results, dir_key, search_terms, flags, cancelled):
+    # a finished search-all leaves every term's results in the cache,
+    # in file order like a single search would
+    per_term = {search_term: {} for search_term in search_terms}
+    for term, filename, matches in results:
+        per_term[term][filename] = matches
+        yield term, filename, matches
+    if cancelled is not None and cancelled.is_set():
+        return
+    cache = get_cache()
+    for term, found in per_term.items():
+        cache.put(dir_key + (term,) + flags, sorted(found.items()))
+
+
+def get_archive(path):
+    # decompressed archives by content hash, a rebuilt archive hashes
+    # differently so its stale copy just ages out
+    from bnd import open_archive
+    digest = get_manifest().digest(path)
+    with _archive_lock:
+        archive = _archives.pop(digest, None)
+        if archive is None:
+            archive = open_archive(path)
+        _archives[digest] = archive
+        while len(_archives) > ARCHIVE_CACHE_SIZE:
+            _archives.popitem(last=False)
+    return archive
+
+
+def packed_archives(dir):
+    return DirectorySnapshot(dir).with_suffix(PACKED_SUFFIX)
+
+
+def packed_entries(dir, span=None):
+    # ('m01.luabnd.dcx:m01_00_00_00.lua', bytes) for every packed .lua
+    for archive_name in packed_archives(dir):
+        archive = get_archive(os.path.join(dir, archive_name))
+        for name, entry in archive.files('.lua'):
+            data = archive.read(entry)
+            if span is not None:
+                span.add(files=1, bytes=len(data))
+            yield f'{archive_name}:{name}', data
+
+
+def read_packed(dir, name):
+    archive_name, entry_name = name.split(':', 1)
+    return get_archive(os.path.join(dir, archive_name)).get(entry_name)
+
+
+def find_packed_iter(dir, search_term, case_sensitive=False, regex=False,
+                     cancelled=None):
+    # searches the .lua files inside the region archives instead of
+    # the loose ones, results are named archive:file
+    from search import search_entries
+    span = profiler.start(
+        'find_packed', term=search_term, case_sensitive=bool(case_sensitive),
+        regex=bool(regex)
+    )
+    results = search_entries(
+        packed_entries(dir, span), search_term, case_sensitive, regex,
+        cancelled
+    )
+    return timed(results, span, lambda r: len(r[1]))
+
+
+def find(dir, search_term, case_sensitive=False, regex=False, workers=None,
+         packed=False):
+    # ['m02_00_00_00.lua', ['line1', 'line2']]
+    from search import SearchResults
+    if packed:
+        results = SearchResults(dir, read=lambda name: read_packed(dir, name))
+        found = find_packed_iter(dir, search_term, case_sensitive, regex)
+    else:
+        results = SearchResults(dir)
+        found = find_iter(dir, search_term, case_sensitive, regex, workers)
+    for filename, matches in found:
+        results.add(filename, matches)
+    return [(f, results.lines(f)[::-1]) for f in sorted(results)]
 
 
 def remove_search(listframe, settings):
@@ -0,0 +1,179 @@
+import argparse
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import struct
+import sys
+import threading
+import time
+
+import utils
+
+from jobs import JobBusy, JobCancelled
+
+
+DEBOUNCE = 0.3
+POLL_INTERVAL = 0.5
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CLOEXEC = 0o2000000
+EVENT = struct.Struct('iIII')
+
+
+def is_lua(filename):
+    return os.path.splitext(filename)[1] == '.lua'
+
+
+class InotifyWatcher:
+    def __init__(self, dir):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        wd = libc.inotify_add_watch(
+            self.fd, os.fsencode(dir), IN_CLOSE_WRITE | IN_MOVED_TO
+        )
+        if wd < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def changes(self, timeout):
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        data = os.read(self.fd, 64 * 1024)
+        i = 0
+        while i < len(data):
+            _, _, _, length = EVENT.unpack_from(data, i)
+            i += EVENT.size
+            name = os.fsdecode(data[i:i + length].rstrip(b'\0'))
+            i += length
+            if is_lua(name):
+                changed.add(name)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    def __init__(self, dir, interval=POLL_INTERVAL):
+        self.dir = dir
+        self.interval = interval
+        self.state = self.scan()
+
+    def scan(self):
+        state = {}
+        with os.scandir(self.dir) as it:
+            for entry in it:
+                if is_lua(entry.name) and entry.is_file():
+                    stat = entry.stat()
+                    state[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        return state
+
+    def changes(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        state = self.scan()
+        changed = {
+            name for name, stamp in state.items()
+            if self.state.get(name) != stamp
+        }
+        self.state = state
+        return changed
+
+    def close(self):
+        pass
+
+
+def make_watcher(dir):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(dir)
+        except (OSError, AttributeError):
+            pass  # no inotify in this libc/kernel
+    return PollingWatcher(dir)
+
+
+class SyncDaemon(threading.Thread):
+    # copies saved base dir .lua files into the region extract dirs,
+    # events are batched until the directory is quiet for DEBOUNCE seconds;
+    # syncs are read from self.events as ('synced', (batch, results)) or
+    # ('error', (batch, exc)), a failed sync doesn't stop the watch; with
+    # a JobScheduler a sync waits for other jobs on the dir, the batch is
+    # kept until then
+    def __init__(self, dir, jobs=None, debounce=DEBOUNCE):
+        super().__init__(daemon=True)
+        self.dir = dir
+        self.jobs = jobs
+        self.events = queue.Queue()
+        self.debounce = debounce
+        self.stopped = threading.Event()
+
+    def run(self):
+        watcher = make_watcher(self.dir)
+        pending = set()
+        try:
+            while not self.stopped.is_set():
+                batch = watcher.changes(POLL_INTERVAL) | pending
+                if not batch:
+                    continue
+                while not self.stopped.is_set():
+                    more = watcher.changes(self.debounce)
+                    if not more:
+                        break
+                    batch |= more
+                pending = set()
+                try:
+                    results = self.update(sorted(batch))
+                    self.events.put(('synced', (batch, results)))
+                except JobBusy:
+                    pending = batch
+                except JobCancelled:
+                    pass
+                except Exception as e:
+                    self.events.put(('error', (batch, e)))
+        finally:
+            watcher.close()
+
+    def update(self, files):
+        if self.jobs is None:
+            return utils.update_global(self.dir, files)
+        job = self.jobs.submit('Sync', utils.update_global, self.dir, files)
+        job.join()
+        if job.status == 'cancelled':
+            raise JobCancelled()
+        if job.status == 'failed':
+            raise job.error
+        return job.result
+
+    def stop(self):
+        self.stopped.set()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Copy base script dir edits into the extract dirs as they are saved'
+    )
+    parser.add_argument('dir')
+    args = parser.parse_args(argv)
+    daemon = SyncDaemon(args.dir)
+    daemon.start()
+    try:
+        while daemon.is_alive():
+            try:
+                kind, (batch, value) = daemon.events.get(timeout=1)
+            except queue.Empty:
+                continue
+            if kind == 'synced':
+                print('synced', *sorted(batch))
+            else:
+                print('sync failed:', value)
+    except KeyboardInterrupt:
+        daemon.stop()
+
+
+if __name__ == '__main__':
+    main()
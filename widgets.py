@@ -1,75 +1,29 @@
 import os
+import queue
 import subprocess
 import tkinter as tk
 import tkinter.filedialog
+import tkinter.font
+import bundle
+import patches
+import repack
 import utils
+import watch
 
-from diff_match_patch import diff_match_patch
-from shutil import copyfile, move
-from utils import BASE_DIR, config_grids
+from profiler import profiler
+from fileops import (
+    prepare_files, reset_permanently, reset_temporarily, restore_modifications
+)
+from utils import config_grids
 
 
 # -------------------------------------------------------
 # -------------------- M E N U B A R --------------------
 # -------------------------------------------------------
 
-DMP = diff_match_patch()
-
-
-def prepare_files(dir):
-    files = os.listdir(dir)
-    paths = [os.path.join(dir, f) for f in files]
-    for filepath in paths:
-        _, ext = os.path.splitext(filepath)
-        if ext in ['.sdat', '.luabnd']:
-            bak_path = filepath + '.bak'
-            if not os.path.isfile(bak_path):
-                os.rename(filepath, bak_path)
-    for filepath in paths:
-        _, ext = os.path.splitext(filepath)
-        if ext == '.dcx':
-            sdat_path = filepath + '.sdat'
-            copyfile(filepath, sdat_path)
-
-
-def flip_files(dir, ext_a, ext_b):
-    files = os.listdir(dir)
-    files = [os.path.splitext(f) for f in files]
-    for file in files:
-        filename, ext = file
-        if ext == '.sdat':
-            sdat_path = os.path.join(dir, filename + ext)
-            ext_a_path = os.path.join(dir, filename + ext + ext_a)
-            move(sdat_path, ext_a_path)
-            # print(filename + ext, '------>', filename + ext + ext_a)
-    for file in files:
-        filename, ext = file
-        if ext == ext_b:
-            filename, subext = os.path.splitext(filename)
-            if subext == '.sdat':
-                ext_b_path = os.path.join(dir, filename + subext + ext_b)
-                sdat_path = os.path.join(dir, filename + subext)
-                move(ext_b_path, sdat_path)
-                # print(filename + subext + ext_b, '------>', filename + subext)
-
-
-def reset_temporarily(dir):
-    flip_files(dir, '.modded', '.bak')
-
-
-def restore_modifications(dir):
-    flip_files(dir, '.bak', '.modded')
-
-
-def reset_permanently(dir):
-    files = os.listdir(dir)
-    for file in files:
-        name, ext = os.path.splitext(file)
-        if ext == '.bak':
-            move(os.path.join(dir, file), os.path.join(dir, name))
-
-
 class Menubar(tk.Menu):
+    WATCH_POLL_MS = 200
+
     def __init__(self, master):
         super().__init__(master)
         self.master = master
@@ -120,7 +74,9 @@ class Menubar(tk.Menu):
         self.prepare_menu.add_command(
             label='Prepare files',
             command=lambda: self.master.open_confirmation(
-                func=lambda: prepare_files(script_dir),
+                func=lambda: self.master.run_job(
+                    'Prepare files', prepare_files, script_dir
+                ),
                 func_text='Prepare files',
                 label='Prepare files for modding?\n\
 (only run once unless you permanently restore,\n\
@@ -129,12 +85,21 @@ Extract dcx files after doing this.'
             )
         )
 
+        self.sync_daemon = None
+        self.var_watch = tk.BooleanVar()
+        self.prepare_menu.add_checkbutton(
+            label='Watch script dir', variable=self.var_watch,
+            command=self.toggle_watch
+        )
+
         self.prepare_menu.add_separator()
 
         self.prepare_menu.add_command(
             label='Reset permanently',
             command=lambda: self.master.open_confirmation(
-                func=lambda: reset_permanently(script_dir),
+                func=lambda: self.master.run_job(
+                    'Reset permanently', reset_permanently, script_dir
+                ),
                 func_text='Reset permanently',
                 label='Reset game files to their original state and\n\
 permanently delete all modifications.'
@@ -144,7 +109,9 @@ permanently delete all modifications.'
         self.prepare_menu.add_command(
             label='Reset temporarily',
             command=lambda: self.master.open_confirmation(
-                func=lambda: reset_temporarily(script_dir),
+                func=lambda: self.master.run_job(
+                    'Reset temporarily', reset_temporarily, script_dir
+                ),
                 func_text='Reset temporarily',
                 label='Reset game files to their original state.\n\
 Modifications can be restored.'
@@ -153,49 +120,158 @@ Modifications can be restored.'
         self.prepare_menu.add_command(
             label='Restore modifications',
             command=lambda: self.master.open_confirmation(
-                func=lambda: restore_modifications(script_dir),
+                func=lambda: self.master.run_job(
+                    'Restore modifications', restore_modifications, script_dir
+                ),
                 func_text='Restore modifications',
                 label='Restore game to previously modified state.'
             ))
 
         self.prepare_menu.add_separator()
 
+        self.prepare_menu.add_command(
+            label='Rebuild dcx files',
+            command=lambda: self.master.run_job(
+                'Rebuild dcx files', repack.build, script_dir,
+                on_finish=self.show_build
+            ))
+
+        self.prepare_menu.add_separator()
+
         self.prepare_menu.add_command(
             label='Generate patches',
             command=lambda: self.master.open_confirmation(
                 func=self.gen_patches,
                 func_text='Generate patches',
-                label='Create patch files for current modifications?\n\n\
-* * * WARNING * * *\nAny previously generated patches will be overwritten.'
+                label='Create patch files for current modifications?\n\
+(regions unchanged since the last run are skipped)\n\n\
+* * * WARNING * * *\nPatches of changed regions will be overwritten.'
             ))
 
+        self.prepare_menu.add_command(
+            label='Apply patches',
+            command=lambda: self.master.open_confirmation(
+                func=lambda: self.master.run_job(
+                    'Apply patches', patches.apply_patches, script_dir,
+                    on_finish=self.show_applied
+                ),
+                func_text='Apply patches',
+                label='Apply patch files to the original sdat files?\n\n\
+* * * WARNING * * *\nCurrent sdat files will be overwritten.'
+            ))
+
+        self.prepare_menu.add_separator()
+
+        self.prepare_menu.add_command(
+            label='Build mod pack',
+            command=lambda: self.master.open_confirmation(
+                func=lambda: self.master.run_job(
+                    'Build mod pack', bundle.build_bundle, script_dir
+                ),
+                func_text='Build mod pack',
+                label=f'Bundle all modified sdat files into\n\
+{bundle.BUNDLE_NAME} next to DeStuff?'
+            ))
+
+        self.prepare_menu.add_command(
+            label='Install mod pack', command=self.install_bundle
+        )
+
         self.debug_menu = tk.Menu(self, tearoff=0)
         self.debug_menu.add_command(
             label='Clear console', command=lambda: os.system('cls')
         )
+        self.performance_window = None
+        self.debug_menu.add_command(
+            label='Performance', command=self.open_performance
+        )
 
         self.add_cascade(label='File', menu=self.file_menu)
         self.add_cascade(label='Prepare', menu=self.prepare_menu)
         self.add_cascade(label='Debug', menu=self.debug_menu)
 
-    def gen_patches(self):
-        nums = [1, 2, 3, 4, 5, 6, 8]
-        for num in nums:
-            sdat_name = f'm0{num}.luabnd.dcx.sdat'
-            sdat_path = os.path.join(self.script_dir, sdat_name)
-            bak_path = sdat_path + '.bak'
+    def toggle_watch(self):
+        if self.var_watch.get() and os.path.isdir(self.script_dir):
+            self.sync_daemon = watch.SyncDaemon(
+                self.script_dir, jobs=self.master.jobs
+            )
+            self.sync_daemon.start()
+            self.after(self.WATCH_POLL_MS, self.drain_sync, self.sync_daemon)
+        else:
+            self.var_watch.set(False)
+            if self.sync_daemon is not None:
+                self.sync_daemon.stop()
+                self.sync_daemon = None
+
+    def drain_sync(self, daemon):
+        if daemon is not self.sync_daemon:
+            return  # watch turned off
+        while True:
             try:
-                with open(sdat_path, 'rb') as infile:
-                    modded_data = infile.read().hex()
-                with open(bak_path, 'rb') as infile:
-                    unmodded_data = infile.read().hex()
-                patches = DMP.patch_make(unmodded_data, modded_data)
-                diff = DMP.patch_toText(patches)
-                patch_name = os.path.split(sdat_name)[1] + '.patch'
-                with open(os.path.join(BASE_DIR, patch_name), 'w+') as outfile:
-                    outfile.write(diff)
-            except FileNotFoundError:
-                print('file not found:', num)
+                kind, (batch, value) = daemon.events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'synced':
+                self.master.set_status(utils.format_results(
+                    'Synced ' + ', '.join(sorted(batch)), value
+                ))
+            else:
+                self.master.set_status(f'Sync failed: {value}')
+        self.after(self.WATCH_POLL_MS, self.drain_sync, daemon)
+
+    def gen_patches(self):
+        self.master.run_job(
+            'Generate patches', patches.gen_patches, self.script_dir,
+            on_finish=lambda results: self.master.set_status(
+                patches.format_applied('Generate patches', {
+                    patches.sdat_name(num): result
+                    for num, result in results.items()
+                }, done='made')
+            )
+        )
+
+    def install_bundle(self):
+        path = tkinter.filedialog.askopenfilename(
+            initialdir=utils.BASE_DIR, title='Browse to a mod pack',
+            filetypes=(('Mod packs', '*.pack'), ('all files', '.*'))
+        )
+        if path:
+            self.master.open_confirmation(
+                func=lambda: self.master.run_job(
+                    'Install mod pack', bundle.apply_bundle, self.script_dir,
+                    path, on_finish=lambda results: self.master.set_status(
+                        patches.format_applied('Install mod pack', results)
+                    )
+                ),
+                func_text='Install',
+                label=f'Apply {os.path.basename(path)} to the original sdat files?\n\n\
+* * * WARNING * * *\nCurrent sdat files will be overwritten.'
+            )
+
+    def show_applied(self, results):
+        self.master.set_status(patches.format_applied('Apply patches', {
+            patches.sdat_name(num): result for num, result in results.items()
+        }))
+
+    def show_build(self, results):
+        rebuilt = [
+            f'm0{num}' for num, result in results['repack'].items()
+            if result['changed']
+        ]
+        self.master.set_status('\n'.join([
+            utils.format_results('Update global files', results['update_global']),
+            'Rebuilt: ' + (', '.join(rebuilt) or 'nothing changed'),
+            utils.format_results('Update sdat files', results['update_sdat']),
+        ]))
+
+    def open_performance(self):
+        if self.performance_window is not None \
+                and self.performance_window.winfo_exists():
+            self.performance_window.lift()
+            return
+        self.performance_window = PerformanceWindow(
+            self.master.master, self.master.master.settings
+        )
 
 
 # ---------------------------------------------------------------
@@ -210,7 +286,7 @@ class ContextMenu(tk.Menu):
         event = self.event
         click_index = event.widget.curselection()
         functions = event.widget.master.context_functions
-        if click_index != -1:
+        if click_index:
             event.widget.select_clear(0, tk.END)
             event.widget.activate(click_index)
             event.widget.selection_set(first=click_index)
@@ -222,10 +298,286 @@ class ContextMenu(tk.Menu):
                 self.post(event.x_root, event.y_root)
 
 
+# -------------------------------------------------------------
+# -------------------- P E R F O R M A N C E --------------------
+# -------------------------------------------------------------
+
+class PerformanceWindow(tk.Toplevel):
+    # rolling summary of the profiled operations, refreshed while open
+    REFRESH_MS = 1000
+
+    def __init__(self, master, settings):
+        bg = settings['colors']['light']
+        fg = settings['colors']['dark']
+        super().__init__(master, bg=bg)
+        self.title('DeStuff - Performance')
+        self.geometry('520x360')
+        config_grids(self, rows=[1, 0], columns=[1, 1, 1])
+
+        self.text = tk.Text(self, bg=bg, fg=fg, relief='groove', wrap='none')
+        self.text.grid(row=0, column=0, columnspan=3, sticky='nsew')
+
+        buttons = [
+            ('Export JSON', lambda: self.export(trace=False)),
+            ('Export trace', lambda: self.export(trace=True)),
+            ('Clear', self.clear),
+        ]
+        for column, (text, command) in enumerate(buttons):
+            tk.Button(
+                self, text=text, command=command, relief='groove',
+                bg=bg, fg=fg
+            ).grid(row=1, column=column, sticky='nsew')
+
+        self.refresh()
+
+    def refresh(self):
+        if not self.winfo_exists():
+            return
+        self.show_summary()
+        self.after(self.REFRESH_MS, self.refresh)
+
+    def show_summary(self):
+        text = profiler.format_summary() or 'nothing recorded yet'
+        if self.text.get('1.0', 'end-1c') != text:
+            self.text.delete('1.0', tk.END)
+            self.text.insert('1.0', text)
+
+    def export(self, trace=False):
+        path = tkinter.filedialog.asksaveasfilename(
+            parent=self, defaultextension='.json',
+            initialfile='destuff-trace.json' if trace else 'destuff-profile.json',
+            filetypes=(('JSON files', '*.json'), ('all files', '.*'))
+        )
+        if path:
+            profiler.export(path, trace=trace)
+
+    def clear(self):
+        profiler.clear()
+        self.show_summary()
+
+
 # -----------------------------------------------------------
 # -------------------- L I S T B O X E S --------------------
 # -----------------------------------------------------------
 
+class VirtualListbox(tk.Listbox):
+    # Listbox that keeps every row in self.items and only hands the rows
+    # that fit in the widget to Tk. Indexes and selections in the public
+    # methods are model indexes, the Tk widget only ever sees the window
+    # starting at self.top.
+    def __init__(self, master, *args, yscrollcommand=None, **kwargs):
+        super().__init__(master, *args, **kwargs)
+        self.items = []
+        self.top = 0
+        self.selected = set()
+        self.yscrollcommand = yscrollcommand
+        self.formatter = str  # row text for a model item
+        self.render_pending = False
+        self.line_height = tkinter.font.Font(
+            font=self.cget('font')
+        ).metrics('linespace') + 1 + 2 * int(self.cget('selectborderwidth'))
+        self.bind('<Configure>', lambda event: self.schedule_render())
+        self.bind('<MouseWheel>', self.wheel)
+        self.bind('<Button-4>', lambda event: self.scroll(-3))
+        self.bind('<Button-5>', lambda event: self.scroll(3))
+        self.bind('<Up>', lambda event: self.step_selection(-1))
+        self.bind('<Down>', lambda event: self.step_selection(1))
+
+    def rows(self):
+        return max(1, self.winfo_height() // self.line_height)
+
+    def index_of(self, index):
+        # model index of an existing row, END is the last one (-1 when
+        # empty) and an empty curselection() is None
+        if isinstance(index, (tuple, list)):
+            if not index:
+                return None
+            index = index[0]
+        if index == tk.END:
+            return len(self.items) - 1
+        return int(index)
+
+    def in_view(self, index):
+        return self.top <= index < self.top + self.rows()
+
+    def sync_selection(self):
+        # clicks/keys handled by the Tk class bindings change the visible
+        # selection directly, fold that back into the model first
+        visible = super().curselection()
+        if visible:
+            self.selected = {self.top + i for i in visible}
+
+    def detach_selection(self):
+        # before rows move: the model keeps the selection, the stale
+        # visible one is dropped until the next render
+        self.sync_selection()
+        super().selection_clear(0, tk.END)
+
+    def schedule_render(self):
+        if not self.render_pending:
+            self.render_pending = True
+            self.after_idle(self.render)
+
+    def render(self):
+        self.render_pending = False
+        self.sync_selection()  # keys/Shift-clicks since the last render
+        rows = self.rows()
+        self.top = max(0, min(self.top, len(self.items) - rows))
+        super().delete(0, tk.END)
+        window = self.items[self.top:self.top + rows]
+        if window:
+            super().insert(tk.END, *map(self.formatter, window))
+        for index in self.selected:
+            if self.in_view(index):
+                super().selection_set(index - self.top)
+        super().yview_moveto(0)
+        if self.yscrollcommand is not None:
+            if self.items:
+                first = self.top / len(self.items)
+                last = min(1, (self.top + rows) / len(self.items))
+            else:
+                first, last = 0, 1
+            self.yscrollcommand(first, last)
+
+    def set_items(self, items):
+        super().selection_clear(0, tk.END)
+        self.items = list(items)
+        self.selected.clear()
+        self.top = 0
+        self.schedule_render()
+
+    def insert(self, index, *elements):
+        # END is after the last row here, not on it
+        index = len(self.items) if index == tk.END else self.index_of(index)
+        if index is None:
+            return
+        self.detach_selection()
+        self.items[index:index] = elements
+        self.selected = {
+            i + len(elements) if i >= index else i for i in self.selected
+        }
+        self.schedule_render()
+
+    def delete(self, first, last=None):
+        first = self.index_of(first)
+        if first is None or first < 0:
+            return
+        last = first if last is None else self.index_of(last)
+        last = min(last, len(self.items) - 1)
+        count = last - first + 1
+        if count <= 0:
+            return
+        self.detach_selection()
+        del self.items[first:last + 1]
+        self.selected = {
+            i - count if i > last else i
+            for i in self.selected if not first <= i <= last
+        }
+        self.schedule_render()
+
+    def get(self, first, last=None):
+        first = self.index_of(first)
+        if first is None or not 0 <= first < len(self.items):
+            return '' if last is None else ()  # as Tk does for no rows
+        if last is None:
+            return self.items[first]
+        return tuple(self.items[first:self.index_of(last) + 1])
+
+    def size(self):
+        return len(self.items)
+
+    def nearest(self, y):
+        return min(self.top + super().nearest(y), len(self.items) - 1)
+
+    def curselection(self):
+        self.sync_selection()
+        return tuple(sorted(self.selected))
+
+    def selection_set(self, first, last=None):
+        first = self.index_of(first)
+        if first is None:
+            return
+        first = max(0, first)
+        last = first if last is None else self.index_of(last)
+        last = min(last, len(self.items) - 1)
+        self.selected.update(range(first, last + 1))
+        for index in range(first, last + 1):
+            if self.in_view(index):
+                super().selection_set(index - self.top)
+
+    select_set = selection_set
+
+    def selection_clear(self, first, last=None):
+        self.sync_selection()
+        first = self.index_of(first)
+        if first is None:
+            return
+        last = first if last is None else self.index_of(last)
+        self.selected = {i for i in self.selected if not first <= i <= last}
+        super().selection_clear(0, tk.END)
+        self.schedule_render()
+
+    select_clear = selection_clear
+
+    def activate(self, index):
+        index = self.index_of(index)
+        if index is not None and self.in_view(index):
+            super().activate(index - self.top)
+
+    def see(self, index):
+        index = self.index_of(index)
+        if index is not None and not self.in_view(index):
+            self.detach_selection()
+            self.top = max(0, index - self.rows() // 2)
+            self.schedule_render()
+
+    def step_selection(self, step):
+        # arrow keys, the class bindings would stop at the rendered rows
+        if not self.items:
+            return 'break'
+        selection = self.curselection()
+        if selection:
+            index = selection[-1] + step if step > 0 else selection[0] + step
+        else:
+            index = self.top
+        index = max(0, min(index, len(self.items) - 1))
+        super().selection_clear(0, tk.END)
+        self.selected = {index}
+        if index < self.top:
+            self.top = index
+        elif index >= self.top + self.rows():
+            self.top = index - self.rows() + 1
+        self.render()
+        super().activate(index - self.top)
+        self.event_generate('<<ListboxSelect>>')
+        return 'break'
+
+    def scroll(self, amount):
+        self.detach_selection()
+        self.top = max(0, self.top + amount)
+        self.render()
+        return 'break'
+
+    def wheel(self, event):
+        return self.scroll(-3 if event.delta > 0 else 3)
+
+    def yview(self, *args):
+        if not args:
+            if not self.items:
+                return 0.0, 1.0
+            return (self.top / len(self.items),
+                    min(1.0, (self.top + self.rows()) / len(self.items)))
+        if args[0] == 'moveto':
+            self.detach_selection()
+            self.top = int(float(args[1]) * len(self.items))
+            self.render()
+        elif args[0] == 'scroll':
+            amount = int(args[1])
+            if args[2] == 'pages':
+                amount *= self.rows()
+            self.scroll(amount)
+
+
 class ScrollbarListFrame(tk.Frame):
     def __init__(self, master, label='', *args, list_style={}, **kwargs):
         super().__init__(master, *args, **kwargs)
@@ -244,7 +596,7 @@ class ScrollbarListFrame(tk.Frame):
         self.scrollbar = tk.Scrollbar(self)
         self.scrollbar.grid(row=1, column=1, sticky='ns')
 
-        self.listbox = tk.Listbox(
+        self.listbox = VirtualListbox(
             self, yscrollcommand=self.scrollbar.set, **list_style,
             exportselection=0
         )
@@ -282,5 +634,4 @@ class ScrollbarListFrame(tk.Frame):
         self.listbox.delete(0, tk.END)
 
     def populate(self):
-        for i in range(100):
-            self.listbox.insert(tk.END, f'Item {i}')
+        self.listbox.set_items(f'Item {i}' for i in range(100))
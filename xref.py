@@ -0,0 +1,167 @@
+import os
+import re
+
+from index import FileIndex, read_lines
+
+
+XREF_VERSION = 1
+
+TOKEN = re.compile(r'''
+    (?P<comment>--\[(?P<ceq>=*)\[.*?\](?P=ceq)\]|--[^\n]*)
+  | (?P<lstring>\[(?P<seq>=*)\[.*?\](?P=seq)\])
+  | (?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+  | (?P<number>0[xX][0-9a-fA-F]+|\d+(?:\.\d*)?(?:[eE][+-]?\d+)?)
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<op>\.\.\.|\.\.|==|~=|<=|>=|[^\s\w])
+''', re.S | re.X)
+IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*$')
+CONSTANT = re.compile(r'[A-Z][A-Z0-9]*_[A-Z0-9_]+$')
+
+
+def tokenize(text):
+    # [(kind, value, line)], comments dropped, string quotes stripped
+    tokens = []
+    line = 1
+    pos = 0
+    for match in TOKEN.finditer(text):
+        line += text.count('\n', pos, match.start())
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group()
+        if kind == 'lstring':
+            eq = len(match.group('seq'))
+            tokens.append(('string', value[eq + 2:-eq - 2], line))
+        elif kind == 'string':
+            tokens.append(('string', value[1:-1], line))
+        elif kind in ('number', 'name', 'op'):
+            tokens.append((kind, value, line))
+        line += value.count('\n')
+    return tokens
+
+
+def dotted_name(tokens, end):
+    # name ending at tokens[end] with any a.b:c prefix
+    name = tokens[end][1]
+    while end >= 2 and tokens[end - 1][1] in ('.', ':') \
+            and tokens[end - 2][0] == 'name':
+        name = tokens[end - 2][1] + tokens[end - 1][1] + name
+        end -= 2
+    return name
+
+
+def parse(tokens):
+    defs = []
+    calls = []
+    refs = []
+    uses = []
+    numbers = []
+    calls_open = []  # enclosing call name (or None) per open paren
+    i = 0
+    while i < len(tokens):
+        kind, value, line = tokens[i]
+        next_value = tokens[i + 1][1] if i + 1 < len(tokens) else None
+        context = calls_open[-1] if calls_open else None
+        if kind == 'name' and value == 'function' \
+                and i + 1 < len(tokens) and tokens[i + 1][0] == 'name':
+            end = i + 1
+            while end + 2 < len(tokens) and tokens[end + 1][1] in ('.', ':') \
+                    and tokens[end + 2][0] == 'name':
+                end += 2
+            name = ''.join(t[1] for t in tokens[i + 1:end + 1])
+            defs.append((name, line))
+            i = end + 1
+            continue
+        if kind == 'name' and next_value == '=' and i + 2 < len(tokens) \
+                and tokens[i + 2][1] == 'function':
+            defs.append((dotted_name(tokens, i), line))
+        elif kind == 'name' and next_value == '(':
+            name = dotted_name(tokens, i)
+            if value not in ('function', 'if', 'while', 'and', 'or', 'not',
+                             'return', 'elseif', 'until', 'in'):
+                calls.append((name, line))
+                calls_open.append(name)
+                i += 2
+                continue
+        elif kind == 'name' and CONSTANT.match(value):
+            uses.append((value, line))
+        elif kind == 'string' and IDENTIFIER.match(value):
+            refs.append((value, line, context))
+        elif kind == 'number':
+            try:
+                numbers.append((int(value, 0), line, context))
+            except ValueError:
+                pass  # floats aren't event ids
+        if value == '(':
+            calls_open.append(None)
+        elif value == ')' and calls_open:
+            calls_open.pop()
+        i += 1
+    return {
+        'defs': defs, 'calls': calls, 'refs': refs,
+        'uses': uses, 'numbers': numbers
+    }
+
+
+def short_name(name):
+    return re.split('[.:]', name)[-1]
+
+
+class XrefIndex(FileIndex):
+    # definitions, call sites, handler names passed as strings, constant
+    # uses and integer literals (with the call they are passed to)
+    version = XREF_VERSION
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.lookups = {}
+
+    def index_file(self, path):
+        return parse(tokenize(''.join(read_lines(path))))
+
+    def refresh(self, dir, snapshot=None):
+        # the lookup is rebuilt only when this refresh changed an entry
+        unsaved = self.dirty
+        self.dirty = False
+        filenames = super().refresh(dir, snapshot)
+        key = os.path.abspath(dir)
+        if self.dirty or key not in self.lookups:
+            self.lookups[key] = self.build_lookup(key)
+        self.dirty = self.dirty or unsaved
+        return filenames
+
+    def build_lookup(self, key):
+        # key -> [(filename, line, kind, context)], names are keyed by
+        # their full and short form, numbers by their int value
+        lookup = {}
+
+        def add(lookup_key, *record):
+            lookup.setdefault(lookup_key, []).append(record)
+
+        for filename, entry in sorted(self.dirs.get(key, {}).items()):
+            for name, line in entry['defs']:
+                add(('def', name), filename, line, 'def', None)
+                if short_name(name) != name:
+                    add(('def', short_name(name)), filename, line, 'def', name)
+            for name, line in entry['calls']:
+                add(('ref', name), filename, line, 'call', None)
+                if short_name(name) != name:
+                    add(('ref', short_name(name)), filename, line, 'call', name)
+            for name, line, context in entry['refs']:
+                add(('ref', name), filename, line, 'string', context)
+            for name, line in entry['uses']:
+                add(('ref', name), filename, line, 'use', None)
+            for value, line, context in entry['numbers']:
+                add(('number', value), filename, line, 'number', context)
+        return lookup
+
+    def lookup(self, dir, key):
+        return self.lookups.get(os.path.abspath(dir), {}).get(key, [])
+
+    def definitions(self, dir, name):
+        return self.lookup(dir, ('def', name))
+
+    def references(self, dir, name):
+        return self.lookup(dir, ('ref', name))
+
+    def number(self, dir, value):
+        return self.lookup(dir, ('number', value))